@@ -1,21 +1,284 @@
+import os
+import mmap
 import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Domain separation of RFC 6962: a leaf can never be taken for an internal node
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+DIGEST_SIZE = 32
+
+
+def leaf_hash(data):
+    return hashlib.sha256(LEAF_PREFIX + data).digest()
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+def _leaf_hash_view(view, start, length):
+    # Hash a slice of a buffer without copying it, hashlib releases the GIL on large updates
+    h = hashlib.sha256(LEAF_PREFIX)
+    with view[start:start + length] as chunk:
+        h.update(chunk)
+    return h.digest()
+
 
 class MerkleTree:
+    """
+    Merkle tree with binary SHA-256 digests. Level k is one bytearray holding the 32-byte digests of its nodes
+    side by side, level 0 being the leaves. A node without a sibling at the end of a level moves up unchanged,
+    which gives the same root as the Merkle Tree Hash of RFC 6962
+    """
     def __init__(self, data_blocks):
-        self.leaves = [hashlib.sha256(data).hexdigest() for data in data_blocks]
-        self.root = self.build_tree(self.leaves)
-
-    def build_tree(self, nodes):
-        if len(nodes) == 1:
-            return nodes[0]
-        new_level = []
-        for i in range(0, len(nodes), 2):
-            left = nodes[i]
-            right = nodes[i + 1] if i + 1 < len(nodes) else nodes[i]  # Handle odd number of leaves
-            new_level.append(hashlib.sha256((left + right).encode()).hexdigest())
-        return self.build_tree(new_level)
-
-# Example usage
-data = [b"block0", b"block1", b"block2", b"block3", b"block4", b"block5", b"block6", b"block7"]
-tree = MerkleTree(data)
-print("Merkle Root Hash:", tree.root)
\ No newline at end of file
+        leaves = bytearray()
+        for data in data_blocks:
+            leaves += leaf_hash(data)
+        self.size = len(leaves) // DIGEST_SIZE
+        self.levels = [leaves]
+        self.root = self.build_tree()
+
+    def build_tree(self):
+        if self.size == 0:
+            return hashlib.sha256(b"").digest()
+        nodes = self.levels[0]
+        while len(nodes) > DIGEST_SIZE:
+            new_level = bytearray()
+            end = len(nodes) - DIGEST_SIZE
+            for i in range(0, end, 2 * DIGEST_SIZE):
+                # left and right digests are contiguous
+                new_level += hashlib.sha256(NODE_PREFIX + nodes[i:i + 2 * DIGEST_SIZE]).digest()
+            if (len(nodes) // DIGEST_SIZE) & 1:
+                new_level += nodes[end:]        # Handle odd number of nodes
+            self.levels.append(new_level)
+            nodes = new_level
+        return bytes(nodes)
+
+    @classmethod
+    def from_file(cls, path, chunk_size=1 << 20, workers=None):
+        """
+        Merkle root of a file whose leaves are its chunks of chunk_size bytes, the same as MerkleTree(chunks).
+        The file is memory-mapped and the chunks are hashed from memoryview slices by a pool of threads, a bounded
+        number of them in flight. Their digests are folded in order into the frontier of an IncrementalMerkleTree,
+        so memory stays O(log n). The result only has root and size, proof() needs a tree built from the blocks
+        """
+        workers = workers or os.cpu_count() or 1
+        frontier = IncrementalMerkleTree(keep_nodes=False)
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    with ThreadPoolExecutor(workers) as pool:
+                        pending = deque()
+                        for start in range(0, size, chunk_size):
+                            pending.append(pool.submit(_leaf_hash_view, view, start, chunk_size))
+                            if len(pending) >= 4 * workers:
+                                frontier.append_hash(pending.popleft().result())
+                        while pending:
+                            frontier.append_hash(pending.popleft().result())
+
+        tree = cls.__new__(cls)
+        tree.size, tree.levels, tree.root = frontier.size, None, frontier.root
+        return tree
+
+    def leaf(self, i):
+        return bytes(self.levels[0][i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+
+    def proof(self, i):
+        """ Inclusion proof of leaf i: the list of (sibling digest, True if the sibling is on the left) from the leaf up """
+        if self.levels is None:
+            raise ValueError("The levels of this tree were not kept")
+        if not 0 <= i < self.size:
+            raise IndexError("Leaf index out of range")
+        path = []
+        for nodes in self.levels[:-1]:
+            j = i ^ 1
+            if j * DIGEST_SIZE < len(nodes):
+                path.append((bytes(nodes[j * DIGEST_SIZE:(j + 1) * DIGEST_SIZE]), j < i))
+            i >>= 1
+        return path
+
+    @staticmethod
+    def verify(leaf, proof, root):
+        """ Check that the data block leaf is in the tree of the given root """
+        h = leaf_hash(leaf)
+        for sibling, left in proof:
+            h = node_hash(sibling, h) if left else node_hash(h, sibling)
+        return h == root
+
+
+class IncrementalMerkleTree:
+    """
+    Append-only Merkle tree with the roots of RFC 6962, for logs growing one entry at a time.
+    Level k holds the roots of the complete subtrees of 2^k leaves, in order. The right-edge frontier is the last
+    node of every level k where bit k of the size is set: append hashes the new leaf into it, at most log n node
+    hashes and one on average, and the root folds it in O(log n).
+    With keep_nodes=False only the frontier is kept, in O(log n) memory, and consistency proofs are not available
+    """
+    def __init__(self, keep_nodes=True):
+        self.keep_nodes = keep_nodes
+        self.size = 0
+        self.levels = [bytearray()]
+
+    def append(self, data):
+        """ Append a data block, return its index """
+        return self.append_hash(leaf_hash(data))
+
+    def append_hash(self, node):
+        """ Append a leaf given by its leaf_hash """
+        k, size = 0, self.size
+        while size & 1:
+            # The left sibling of node is waiting on the frontier
+            nodes = self.levels[k]
+            left = bytes(nodes[-DIGEST_SIZE:])
+            if self.keep_nodes:
+                nodes += node
+            else:
+                del nodes[:]
+            node = node_hash(left, node)
+            k, size = k + 1, size >> 1
+            if k == len(self.levels):
+                self.levels.append(bytearray())
+        self.levels[k] += node
+        self.size += 1
+        return self.size - 1
+
+    @property
+    def root(self):
+        r = None
+        for k, nodes in enumerate(self.levels):
+            if (self.size >> k) & 1:
+                r = bytes(nodes[-DIGEST_SIZE:]) if r is None else node_hash(nodes[-DIGEST_SIZE:], r)
+        return hashlib.sha256(b"").digest() if r is None else r
+
+    def _subtree(self, lo, hi):
+        # Merkle Tree Hash of the leaves lo..hi-1, lo being a multiple of the largest power of 2 below hi - lo
+        n = hi - lo
+        if n & (n - 1) == 0:
+            k = n.bit_length() - 1
+            return bytes(self.levels[k][(lo >> k) * DIGEST_SIZE:((lo >> k) + 1) * DIGEST_SIZE])
+        split = 1 << ((n - 1).bit_length() - 1)
+        return node_hash(self._subtree(lo, lo + split), self._subtree(lo + split, hi))
+
+    def root_at(self, size):
+        """ The root the tree had with its first size leaves """
+        if not self.keep_nodes:
+            raise ValueError("Past roots need keep_nodes=True")
+        if not 0 <= size <= self.size:
+            raise ValueError("Size out of range")
+        return self._subtree(0, size) if size else hashlib.sha256(b"").digest()
+
+    def consistency_proof(self, old_size, new_size=None):
+        """ RFC 6962 (2.1.2) proof that the tree of new_size leaves (default: the current one) extends the one of old_size """
+        if new_size is None:
+            new_size = self.size
+        if not self.keep_nodes:
+            raise ValueError("Consistency proofs need keep_nodes=True")
+        if not 0 < old_size <= new_size <= self.size:
+            raise ValueError("Sizes out of range")
+
+        proof = []
+        lo, hi, m, complete = 0, new_size, old_size, True
+        while m != hi - lo:
+            split = 1 << ((hi - lo - 1).bit_length() - 1)
+            if m <= split:
+                proof.append(self._subtree(lo + split, hi))
+                hi = lo + split
+            else:
+                proof.append(self._subtree(lo, lo + split))
+                lo, m, complete = lo + split, m - split, False
+        if not complete:
+            proof.append(self._subtree(lo, hi))
+        return proof[::-1]
+
+    @staticmethod
+    def verify_consistency(old_size, new_size, old_root, new_root, proof):
+        """ Check a consistency proof between the roots of two sizes of a log (RFC 9162, 2.1.4.2) """
+        if not 0 < old_size <= new_size:
+            return False
+        if old_size == new_size:
+            return not proof and old_root == new_root
+        if old_size & (old_size - 1) == 0:
+            proof = [old_root] + list(proof)
+        if not proof:
+            return False
+
+        fn, sn = old_size - 1, new_size - 1
+        while fn & 1:
+            fn, sn = fn >> 1, sn >> 1
+        fr = sr = proof[0]
+        for c in proof[1:]:
+            if sn == 0:
+                return False
+            if fn & 1 or fn == sn:
+                fr, sr = node_hash(c, fr), node_hash(c, sr)
+                while fn and not fn & 1:
+                    fn, sn = fn >> 1, sn >> 1
+            else:
+                sr = node_hash(sr, c)
+            fn, sn = fn >> 1, sn >> 1
+        return sn == 0 and fr == old_root and sr == new_root
+
+
+if __name__ == '__main__':
+    # Example usage
+    data = [b"block0", b"block1", b"block2", b"block3", b"block4", b"block5", b"block6", b"block7"]
+    tree = MerkleTree(data)
+    print("Merkle Root Hash:", tree.root.hex())
+
+    for n in range(1, 20):
+        blocks = [bytes([i]) * i for i in range(n)]
+        tree = MerkleTree(blocks)
+        for i, block in enumerate(blocks):
+            proof = tree.proof(i)
+            assert MerkleTree.verify(block, proof, tree.root)
+            assert not MerkleTree.verify(block + b"x", proof, tree.root)
+        # A leaf digest is not a valid block, nor an internal node a valid leaf
+        assert not MerkleTree.verify(tree.leaf(0), tree.proof(0), tree.root)
+    print("Inclusion proofs: OK")
+
+    # The incremental tree has the same roots, and its consistency proofs check between any two sizes
+    log = IncrementalMerkleTree()
+    blocks = []
+    for n in range(1, 40):
+        blocks.append(b"entry %d" % n)
+        log.append(blocks[-1])
+        assert log.root == MerkleTree(blocks).root
+    for n in range(1, log.size + 1):
+        for m in range(1, n + 1):
+            proof = log.consistency_proof(m, n)
+            assert IncrementalMerkleTree.verify_consistency(m, n, log.root_at(m), log.root_at(n), proof)
+            if m < n:
+                assert not IncrementalMerkleTree.verify_consistency(m, n, log.root_at(m - 1) if m > 1 else b"", log.root_at(n), proof)
+    print("Incremental roots and consistency proofs: OK")
+
+    from time import perf_counter
+    count = 1000000
+    for keep_nodes in (True, False):
+        log = IncrementalMerkleTree(keep_nodes)
+        start = perf_counter()
+        for i in range(count):
+            log.append(i.to_bytes(8, 'big'))
+        print("{} appends (keep_nodes={}): {:.1f} s".format(count, keep_nodes, perf_counter() - start))
+
+    import tempfile
+    with tempfile.NamedTemporaryFile() as f:
+        for size in (0, 1, 4096, 4097, 3 * 4096 + 5):
+            f.seek(0)
+            f.truncate()
+            data = os.urandom(size)
+            f.write(data)
+            f.flush()
+            chunks = [data[i:i + 4096] for i in range(0, size, 4096)]
+            assert MerkleTree.from_file(f.name, 4096, workers=3).root == MerkleTree(chunks).root
+        print("Merkle root of a file: OK")
+
+        size = 1 << 28
+        f.seek(0)
+        f.truncate()
+        for _ in range(size >> 24):
+            f.write(os.urandom(1 << 24))
+        f.flush()
+        start = perf_counter()
+        MerkleTree.from_file(f.name)
+        print("from_file: {:.0f} MB/s".format(size / (1 << 20) / (perf_counter() - start)))
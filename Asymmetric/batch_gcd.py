@@ -0,0 +1,279 @@
+"""
+Batch GCD auditor: find RSA moduli sharing a prime factor among a large set of public keys.
+Bernstein's algorithm builds the product tree of all moduli N_i and goes down a remainder tree, so that each leaf gets
+(P / N_i) mod N_i where P is the product of all moduli: gcd((P / N_i) mod N_i, N_i) is the product of the primes N_i
+shares with the other moduli, without the n^2 pairwise gcds. The variant used here carries at every node v the product
+of all the leaves outside v, modulo v: a child c with sibling s gets it as (R_v * s) mod c, which keeps the numbers
+smaller than the classic P mod N^2 and never materializes P.
+
+The moduli are split into one chunk per worker process. Each worker builds the product tree of its chunk level by
+level in files, so that only a few nodes are in memory at a time, and the main process only combines the chunk roots.
+Descending the remainder tree streams the same files. Big-number arithmetic uses gmpy2 when it is installed, which
+makes the whole computation quasi-linear. With plain Python ints, products use Karatsuba and the large reductions
+a recursive division (as Burnikel-Ziegler), since the built-in one is quadratic before Python 3.12.
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+from math import gcd
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from gmpy2 import mpz
+except ImportError:
+    mpz = None
+
+
+# Below this many bits of quotient, the built-in division is the fastest
+_DIV_LIMIT = 4000
+
+def _div2n1n(a, b, n):
+    # (a // b, a % b) for b of exactly n bits and a < 2^n * b, by two recursive 3n/2n-by-n divisions
+    if a.bit_length() - n <= _DIV_LIMIT:
+        return divmod(a, b)
+    pad = n & 1
+    if pad:
+        a, b, n = a << 1, b << 1, n + 1
+    half = n >> 1
+    mask = (1 << half) - 1
+    b1, b2 = b >> half, b & mask
+    q1, r = _div3n2n(a >> n, (a >> half) & mask, b, b1, b2, half)
+    q2, r = _div3n2n(r, a & mask, b, b1, b2, half)
+    return q1 << half | q2, r >> pad
+
+def _div3n2n(a12, a3, b, b1, b2, n):
+    if a12 >> n == b1:
+        q, r = (1 << n) - 1, a12 - (b1 << n) + b1
+    else:
+        q, r = _div2n1n(a12, b1, n)
+    r = (r << n | a3) - q * b2
+    while r < 0:
+        q -= 1
+        r += b
+    return q, r
+
+def _mod(a, b):
+    """ a mod b for big nonnegative a and positive b """
+    if mpz is not None or a.bit_length() - b.bit_length() <= _DIV_LIMIT:
+        return a % b
+    # Schoolbook division with digits of n bits, each digit step being a recursive division
+    n = b.bit_length()
+    r = 0
+    for shift in range((a.bit_length() - 1) // n * n, -1, -n):
+        _, r = _div2n1n(r << n | (a >> shift) & ((1 << n) - 1), b, n)
+    return r
+
+def _int(x):
+    return mpz(x) if mpz is not None else x
+
+
+def _write_int(f, x):
+    b = int(x).to_bytes((x.bit_length() + 7) // 8, 'big')
+    f.write(len(b).to_bytes(8, 'big'))
+    f.write(b)
+
+def _read_ints(path):
+    with open(path, 'rb') as f:
+        while True:
+            size = f.read(8)
+            if not size:
+                return
+            yield _int(int.from_bytes(f.read(int.from_bytes(size, 'big')), 'big'))
+
+def _level_path(workdir, chunk, level, kind):
+    return os.path.join(workdir, "{}-{}-{}".format(chunk, kind, level))
+
+
+def _product_tree(workdir, chunk, moduli):
+    """ Write the levels of the product tree of moduli, leaves first. Return the root and the number of levels """
+    path = _level_path(workdir, chunk, 0, "prod")
+    with open(path, 'wb') as f:
+        for N in moduli:
+            _write_int(f, _int(N))
+
+    level, count = 0, len(moduli)
+    while count > 1:
+        level += 1
+        with open(_level_path(workdir, chunk, level, "prod"), 'wb') as f:
+            it = _read_ints(path)
+            for x in it:
+                y = next(it, None)
+                _write_int(f, x if y is None else x * y)
+        path, count = _level_path(workdir, chunk, level, "prod"), (count + 1) // 2
+    return next(_read_ints(path)), level
+
+def _remainder_tree(workdir, chunk, levels, rem):
+    """
+    Go down the product tree of the chunk from rem, the product of the moduli outside the chunk modulo its root.
+    Return gcd(R_N, N) for every leaf N
+    """
+    with open(_level_path(workdir, chunk, levels, "rem"), 'wb') as f:
+        _write_int(f, rem)
+
+    for level in range(levels - 1, -1, -1):
+        children = _read_ints(_level_path(workdir, chunk, level, "prod"))
+        with open(_level_path(workdir, chunk, level, "rem"), 'wb') as f:
+            for r in _read_ints(_level_path(workdir, chunk, level + 1, "rem")):
+                left, right = next(children), next(children, None)
+                if right is None:
+                    _write_int(f, r)
+                else:
+                    _write_int(f, _mod(r * right, left))
+                    _write_int(f, _mod(r * left, right))
+        os.remove(_level_path(workdir, chunk, level + 1, "rem"))
+        os.remove(_level_path(workdir, chunk, level + 1, "prod"))
+
+    gcds = []
+    leaves = _read_ints(_level_path(workdir, chunk, 0, "prod"))
+    for r, N in zip(_read_ints(_level_path(workdir, chunk, 0, "rem")), leaves):
+        gcds.append(int(gcd(r, N)))
+    os.remove(_level_path(workdir, chunk, 0, "rem"))
+    os.remove(_level_path(workdir, chunk, 0, "prod"))
+    return gcds
+
+
+def _top_remainders(roots):
+    """
+    Top of the tree, in memory: the product of the other chunk roots modulo each root, going down a product tree
+    of the roots. log2(len(roots)) levels instead of a product for every pair of roots
+    """
+    levels = [roots]
+    while len(levels[-1]) > 1:
+        nodes = levels[-1]
+        levels.append([nodes[i] * nodes[i + 1] if i + 1 < len(nodes) else nodes[i] for i in range(0, len(nodes), 2)])
+
+    rems = [_mod(_int(1), levels[-1][0])]
+    for nodes in reversed(levels[:-1]):
+        children = []
+        for i, r in enumerate(rems):
+            left = nodes[2*i]
+            if 2*i + 1 < len(nodes):
+                right = nodes[2*i + 1]
+                children += [_mod(r * right, left), _mod(r * left, right)]
+            else:
+                children.append(r)
+        rems = children
+    return rems
+
+
+def batch_gcd(moduli, workers=None, workdir=None):
+    """
+    Return g_i = gcd(N_i, prod_{j != i} N_j) for every modulus, g_i > 1 when N_i shares a factor with another modulus.
+    g_i = N_i when both of its primes are shared, or the modulus appears twice: see shared_factors
+    """
+    moduli = list(moduli)
+    if len(moduli) < 2:
+        return [1] * len(moduli)
+    workers = min(workers or os.cpu_count() or 1, len(moduli))
+    step = -(-len(moduli) // workers)
+    chunks = [moduli[i:i + step] for i in range(0, len(moduli), step)]
+
+    tmp = tempfile.mkdtemp(prefix="batchgcd-", dir=workdir)
+    try:
+        with ProcessPoolExecutor(len(chunks)) as pool:
+            roots = list(pool.map(_product_tree, [tmp] * len(chunks), range(len(chunks)), chunks))
+            rems = _top_remainders([root for root, _ in roots])
+            results = pool.map(_remainder_tree, [tmp] * len(chunks), range(len(chunks)), [levels for _, levels in roots], rems)
+            return [g for gcds in results for g in gcds]
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def shared_factors(moduli, workers=None, workdir=None):
+    """
+    Audit moduli and return {index: factor} for every weak one, where factor is a non-trivial factor of moduli[index].
+    Moduli whose batch gcd is the modulus itself are split by pairwise gcds among the few weak ones.
+    Repeated moduli cannot be split that way and are reported with factor equal to the modulus
+    """
+    moduli = [int(N) for N in moduli]
+    weak = {i: g for i, g in enumerate(batch_gcd(moduli, workers, workdir)) if g != 1}
+    for i, g in weak.items():
+        if g != moduli[i]:
+            continue
+        for j in weak:
+            f = gcd(moduli[i], moduli[j])
+            if 1 < f < moduli[i]:
+                weak[i] = f
+                break
+    return weak
+
+
+_INT = re.compile(rb"0[xX][0-9a-fA-F]+|\d+")
+
+def load_moduli(path):
+    """
+    Read the moduli of a file:
+    - PEM public keys, certificates or unencrypted private keys (any number of them)
+    - otherwise a dump of get_publickeys() lists, one key per line such as "[N, e]" or "N e": the first integer is N
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b"-----BEGIN" not in data:
+        return [int(m.group(), 0) for m in map(_INT.search, data.splitlines()) if m]
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+
+    moduli = []
+    for m in re.finditer(rb"-----BEGIN ([A-Z0-9 ]+)-----.*?-----END \1-----", data, re.S):
+        pem, kind = m.group(), m.group(1)
+        if kind == b"CERTIFICATE":
+            key = x509.load_pem_x509_certificate(pem).public_key()
+        elif kind.endswith(b"PRIVATE KEY"):
+            key = serialization.load_pem_private_key(pem, password=None).public_key()
+        else:
+            key = serialization.load_pem_public_key(pem)
+        if hasattr(key, "public_numbers") and hasattr(key.public_numbers(), "n"):
+            moduli.append(key.public_numbers().n)
+    return moduli
+
+def dump_publickeys(ciphers, path):
+    """ Append the public keys of RSACipher_Impl instances to a dump file readable by load_moduli """
+    with open(path, 'a') as f:
+        for cipher in ciphers:
+            N, e = cipher.get_publickeys()
+            f.write("{} {}\n".format(N, e))
+
+
+if __name__ == '__main__':
+    import argparse
+    from time import perf_counter
+
+    parser = argparse.ArgumentParser(description="Find RSA moduli sharing prime factors")
+    parser.add_argument("files", nargs="*", help="PEM files or get_publickeys() dumps. Without files, run a self-test")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--workdir", default=None, help="directory of the product tree levels")
+    args = parser.parse_args()
+
+    if args.files:
+        moduli = [N for path in args.files for N in load_moduli(path)]
+        start = perf_counter()
+        weak = shared_factors(moduli, args.workers, args.workdir)
+        for i, f in sorted(weak.items()):
+            print("{}: N = {} shares the factor {}".format(i, hex(moduli[i]), hex(f)))
+        print("{} weak moduli out of {} ({:.1f} s)".format(len(weak), len(moduli), perf_counter() - start), file=sys.stderr)
+        sys.exit(1 if weak else 0)
+
+    from utils import getPrime
+
+    # 512-bit moduli: a few share one prime, one pair shares both, the rest are sound
+    primes = [getPrime(256) for _ in range(420)]
+    moduli = [primes[2*i] * primes[2*i + 1] for i in range(200)]
+    moduli += [primes[0] * primes[400], primes[401] * primes[3], primes[402] * primes[403], primes[402] * primes[403]]
+    moduli += [primes[404] * primes[405], primes[405] * primes[406], primes[406] * primes[404]]
+    expected = {0, 1, 200, 201, 202, 203, 204, 205, 206}
+
+    weak = shared_factors(moduli, workers=3)
+    assert set(weak) == expected
+    for i, f in weak.items():
+        assert moduli[i] % f == 0 and (1 < f < moduli[i] or moduli.count(moduli[i]) > 1)
+    print("Batch GCD self-test: OK")
+
+    # Timing only: random 1024-bit numbers instead of generated moduli
+    count = 4000
+    moduli = [int.from_bytes(os.urandom(128), 'big') | 1 for _ in range(count)]
+    start = perf_counter()
+    batch_gcd(moduli)
+    print("{} 1024-bit moduli: {:.1f} s".format(count, perf_counter() - start))
@@ -1,72 +1,151 @@
 import os
 import hashlib
 import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from Crypto.PublicKey import RSA
 
 import functools
 
+# Size of the SHA-1 values c and v of the ring equation
+HASH_LEN = 20
+
+
+def _g(x, e, n, bound):
+    # Extension of the RSA permutation x -> x^e mod n to [0, 2^l): bound is the largest multiple of n below 2^l
+    if x < bound:
+        q, r = divmod(x, n)
+        return q * n + pow(r, e, n)
+    return x
+
+
+_rand = random.SystemRandom()
+
+
+def _sign_chunk(ring, messages, z):
+    return [ring.sign(m, z) for m in messages]
+
+def _verify_chunk(ring, pairs):
+    return [ring.vrf(m, sig) for m, sig in pairs]
+
 
 class RingSigs:
+    """
+    Ring signatures over the RSA keys k. Nothing about a message is stored on the instance,
+    so one instance can sign and verify from several threads at once
+    """
 
     def __init__(self, k, l: int = 1024) -> None:
         self.k = k
         self.l = l
         self.n = len(k)
         self.q = 1 << (l - 1)
+        # Per-ring constants: width in bytes of the l-bit values, keys as ints and the bounds of _g
+        self.width = (l + 7) // 8
+        self.pub = [(int(key.e), int(key.n)) for key in k]
+        self.priv = {i: int(key.d) for i, key in enumerate(k) if key.has_private()}
+        limit = (1 << l) - 1
+        self.bounds = [limit // n * n for _, n in self.pub]
+
+    def __getstate__(self):
+        # PyCryptodome keys cannot be pickled, worker processes only need the ints
+        state = self.__dict__.copy()
+        state['k'] = None
+        return state
 
     def sign(self, m: str, z: int):
-        self._permut(m)
+        if z not in self.priv:
+            raise ValueError("No private key for member {} of the ring".format(z))
+        h = self._permut(m)
         s = [None] * self.n
-        u = random.randint(0, self.q)
-        c = v = self._E(u)
+        u = _rand.randint(0, self.q)
+        c = v = self._E(h, u)
 
         first_range = list(range(z + 1, self.n))
         second_range = list(range(z))
         whole_range = first_range + second_range
 
         for i in whole_range:
-            s[i] = random.randint(0, self.q)
-            e = self._g(s[i], self.k[i].e, self.k[i].n)
-            v = self._E(v ^ e)
+            s[i] = _rand.randint(0, self.q)
+            e = _g(s[i], *self.pub[i], self.bounds[i])
+            v = self._E(h, v ^ e)
             if (i + 1) % self.n == 0:
                 c = v
 
-        s[z] = self._g(v ^ u, self.k[z].d, self.k[z].n)
-        return [c] + s
+        s[z] = _g(v ^ u, self.priv[z], self.pub[z][1], self.bounds[z])
+        return self.to_bytes([c] + s)
 
     def vrf(self, m: str, sig):
-        self._permut(m)
+        if isinstance(sig, (bytes, bytearray, memoryview)):
+            sig = self.from_bytes(sig)
+        h = self._permut(m)
 
         def _f(i):
-            return self._g(sig[i + 1], self.k[i].e, self.k[i].n)
+            return _g(sig[i + 1], *self.pub[i], self.bounds[i])
 
         y = map(_f, range(len(sig) - 1))
         y = list(y)
 
-        def _g(x, i):
-            return self._E(x ^ y[i])
+        def _step(x, i):
+            return self._E(h, x ^ y[i])
 
-        r = functools.reduce(_g, range(self.n), sig[0])
+        r = functools.reduce(_step, range(self.n), sig[0])
         return r == sig[0]
 
+    def _run(self, func, items, args, workers, executor):
+        # Split items into one chunk per worker and run func(self, chunk, *args) on each, results in the order of items
+        items = list(items)
+        if not items:
+            return []
+        workers = min(workers or os.cpu_count() or 1, len(items))
+        if workers <= 1 and executor is None:
+            return func(self, items, *args)
+        step = -(-len(items) // max(workers, 1))
+        chunks = [items[i:i + step] for i in range(0, len(items), step)]
+        if executor is not None:
+            results = executor.map(func, [self] * len(chunks), chunks, *([a] * len(chunks) for a in args))
+            return [r for chunk in results for r in chunk]
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(func, [self] * len(chunks), chunks, *([a] * len(chunks) for a in args))
+            return [r for chunk in results for r in chunk]
+
+    def sign_many(self, messages, z: int, workers=None, executor=None):
+        """
+        Sign every message as member z. The signatures are computed by a pool of worker processes
+        (default: one per CPU), or by executor if given, which may be a thread or a process pool.
+        The result is in the order of messages
+        """
+        return self._run(_sign_chunk, messages, (z,), workers, executor)
+
+    def verify_many(self, pairs, workers=None, executor=None):
+        """ Verify a list of (m, sig) against the ring, in parallel as sign_many. Return one bool per pair, in order """
+        return self._run(_verify_chunk, pairs, (), workers, executor)
+
+    def to_bytes(self, sig):
+        """ Compact encoding of [c, s_0, ..., s_{n-1}]: c on HASH_LEN bytes then each s_i on l/8 bytes """
+        return sig[0].to_bytes(HASH_LEN, 'big') + b''.join(s.to_bytes(self.width, 'big') for s in sig[1:])
+
+    def from_bytes(self, data):
+        if len(data) != HASH_LEN + self.n * self.width:
+            raise ValueError("Invalid ring signature length")
+        data = bytes(data)
+        sig = [int.from_bytes(data[:HASH_LEN], 'big')]
+        sig += [int.from_bytes(data[i:i + self.width], 'big') for i in range(HASH_LEN, len(data), self.width)]
+        return sig
+
     def _permut(self, m):
+        # The hash state after the message digest, copied by every _E of this message
         msg = m.encode("utf-8")
-        self.p = int(hashlib.sha1(msg).hexdigest(), 16)
+        return hashlib.sha1(hashlib.sha1(msg).digest())
 
-    def _E(self, x):
-        msg = f"{x}{self.p}".encode("utf-8")
-        return int(hashlib.sha1(msg).hexdigest(), 16)
-
-    def _g(self, x, e, n):
-        q, r = divmod(x, n)
-        if ((q + 1) * n) <= ((1 << self.l) - 1):
-            result = q * n + pow(r, e, n)
-        else:
-            result = x
-        return result
+    def _E(self, h, x):
+        h = h.copy()
+        h.update(x.to_bytes(self.width, 'big'))
+        return int.from_bytes(h.digest(), 'big')
 
 
 if __name__ == '__main__':
+    from time import perf_counter
+
     size = 5
     msg1, msg2 = "Hello", "World"
 
@@ -83,8 +162,31 @@ if __name__ == '__main__':
 
     for i in range(size):
         sig1 = r.sign(msg1, i)
-        print(sig1)
+        print(sig1.hex())
         sig2 = r.sign(msg2, i)
-        print(sig2)
+        print(sig2.hex())
 
+        assert len(sig1) == HASH_LEN + size * 128
         assert r.vrf(msg1, sig1) and r.vrf(msg2, sig2) and not r.vrf(msg1, sig2)
+        assert r.verify_many([(msg1, sig1), (msg2, sig2), (msg1, sig2)], workers=2) == [True, True, False]
+
+    # The same instance from several threads, and batches over processes
+    messages = [str(j) for j in range(40)]
+    with ThreadPoolExecutor(4) as pool:
+        sigs = r.sign_many(messages, 2, workers=4, executor=pool)
+        assert r.verify_many(zip(messages, sigs), workers=4, executor=pool) == [True] * len(messages)
+    assert r.verify_many(zip(messages, sigs[1:] + sigs[:1]), workers=2) == [False] * len(messages)
+    assert all(r.verify_many(zip(messages, r.sign_many(messages, 0, workers=2))))
+    with ThreadPoolExecutor(2) as pool:
+        assert r.sign_many([], 0, executor=pool) == r.verify_many([], executor=pool) == r.verify_many([]) == []
+
+    # Verification throughput with a ring of 100 members
+    size, count = 100, 200
+    r = RingSigs([_rn(i) for i in range(size)])
+    pairs = list(zip(map(str, range(count)), r.sign_many(map(str, range(count)), 0)))
+    start = perf_counter()
+    assert all(r.vrf(m, sig) for m, sig in pairs)
+    middle = perf_counter()
+    assert all(r.verify_many(pairs))
+    end = perf_counter()
+    print("Ring of {}: vrf {:.0f} signatures/sec, verify_many {:.0f} signatures/sec".format(size, count / (middle - start), count / (end - middle)))
@@ -1,7 +1,13 @@
-import random 
+import os
+import sys
+import queue
+import atexit
+import secrets
+import threading
+import multiprocessing
 from math import gcd
-from sympy import nextprime
 from Encode.AsymmetricPadding import *
+from utils import sieveWindow, isPrime, mrRounds
 
 '''
 Compute modular inverse a^(-1) mod n using extended Euclidean algorithm  
@@ -21,44 +27,179 @@ def mod_inverse(a, n):
 
     return x1 + n0 if x1 < 0 else x1
 
-class RSACipher_Impl:
-    # Public e could be 3 or 65537 (=2^16 + 1). Modulus must be at least 2048
-    def __init__(self, e = 65537, modulus_length = 2048) -> None:
-        self.e, self.modulus_length = e, modulus_length
-        [N, d] = self.generate_keys()
-        self.private_keys = [N, d]
-        self.public_keys = [N, e]
+def crt_components(primes, d):
+    """
+    CRT representation of the private exponent d (RFC 8017, 3.2): [p, q, dP, dQ, qInv, others],
+    where others holds a (r_i, d_i, t_i) triple for each prime after the first two
+    """
+    p, q = primes[0], primes[1]
+    others = []
+    R = p * q
+    for r in primes[2:]:
+        others.append((r, d % (r - 1), mod_inverse(R % r, r)))
+        R *= r
+    return [p, q, d % (p - 1), d % (q - 1), mod_inverse(q, p), others]
 
+def crt_pow(c, crt_key):
+    """ c^d mod N with one half-size (or smaller) exponentiation per prime, recombined by Garner's formula """
+    p, q, dP, dQ, qInv, others = crt_key
+    m1 = pow(c % p, dP, p)
+    m2 = pow(c % q, dQ, q)
+    m = m2 + q * ((m1 - m2) * qInv % p)
+    R = p * q
+    for r, d_r, t in others:
+        m_r = pow(c % r, d_r, r)
+        m += R * ((m_r - m) * t % r)
+        R *= r
+    return m
 
-    def generate_keys(self):
-        '''
-        Require to avoid faulty key generation: (n = modulus_length)
-        - e and phi(N) must be co-primes, where phi(N) = (p - 1)(q - 1) ==> gcd(e, p - 1) = 1 and gcd(e, q - 1) = 1
-        - p and q should not be too close to avoid Fermat factorization. | p - q | >= 2 N ^ {1 / 4}. 
-        
-        FIPS 186-4 recommends:
-        - | p - q | >= 2 ^ {n / 2 - 100} (page 63), i.e., |p - q| > 2^924 for modulus length = 2048.
-        - sqrt(2)(2^(n/2 - 1)) <= p, q <= 2^(n/2) - 1
-        '''
-        bits = self.modulus_length // 2 - 1
-        safe_diff = (1 << (self.modulus_length // 2 - 100))
-        p = nextprime(random.getrandbits(bits))
-        
-        while gcd(self.e, p - 1) != 1:
-            p = nextprime(random.getrandbits(bits))
+def rsa_prime(low, high, e):
+    """
+    A random prime r in [low, high] with gcd(e, r - 1) = 1.
+    Candidates come from windows of odd numbers sieved by the small primes, starting at a random point,
+    so that Miller-Rabin only runs on the few survivors which are also coprime to e
+    """
+    length = max(64, high.bit_length())
+    rounds = mrRounds(high.bit_length())
+    while True:
+        start = (low + secrets.randbelow(high - low + 1)) | 1
+        for k in sieveWindow(start, length):
+            r = start + 2*k
+            if r > high:
+                break
+            if gcd(e, r - 1) == 1 and isPrime(r, rounds):
+                return r
 
-        q = nextprime(random.getrandbits(bits + 1))
+def generate_keypair(e, modulus_length, nprimes=2):
+    '''
+    Require to avoid faulty key generation: (n = modulus_length)
+    - e and phi(N) must be co-primes, where phi(N) = (p - 1)(q - 1) ==> gcd(e, p - 1) = 1 and gcd(e, q - 1) = 1
+    - p and q should not be too close to avoid Fermat factorization. | p - q | >= 2 N ^ {1 / 4}. 
+    
+    FIPS 186-4 recommends:
+    - | p - q | >= 2 ^ {n / 2 - 100} (page 63), i.e., |p - q| > 2^924 for modulus length = 2048.
+    - sqrt(2)(2^(n/2 - 1)) <= p, q <= 2^(n/2) - 1
 
-        while (gcd(self.e, q - 1) != 1) or (abs(p - q) < safe_diff):
-            q = nextprime(random.getrandbits(bits + 1))
+    With more than two primes, the same conditions hold for every prime and every pair of primes.
+    Return the private key [N, d] followed by its CRT components
+    '''
+    if e < 3 or e % 2 == 0:
+        raise ValueError("The public exponent must be odd and at least 3")
+    bits = modulus_length // nprimes
+    safe_diff = (1 << (bits - 100))
+    primes = []
 
-        N = p * q
-        phi_N = (p - 1) * (q - 1)
-        lambda_N = phi_N // gcd(p - 1, q - 1)    # = lcm(p - 1, q - 1)
-        d = mod_inverse(self.e, lambda_N)
+    while len(primes) < nprimes:
+        if len(primes) < nprimes - 1:
+            r = rsa_prime(1 << (bits - 1), (1 << bits) - 1, e)
+        else:
+            # The last prime brings N to exactly modulus_length bits
+            R = 1
+            for r in primes:
+                R *= r
+            r = rsa_prime(-(-(1 << (modulus_length - 1)) // R), ((1 << modulus_length) - 1) // R, e)
+        if all(abs(r - s) >= safe_diff for s in primes):
+            primes.append(r)
+
+    N = 1
+    lambda_N = 1
+    for r in primes:
+        N *= r
+        lambda_N = lambda_N * (r - 1) // gcd(lambda_N, r - 1)     # = lcm(p - 1, q - 1, ...)
+    d = mod_inverse(e, lambda_N)
+
+    return [N, d] + crt_components(primes, d)
+
+
+def _key_worker(params, keys):
+    # Worker process of RSAKeyPool: generate keys until the pool terminates it, put() waits while the queue is full
+    while True:
+        try:
+            key = generate_keypair(*params)
+        except Exception as error:
+            keys.put(error)
+            return
+        keys.put(key)
+
+class RSAKeyPool:
+    """
+    Private keys generated ahead of time by worker processes.
+    The workers put their keys in a queue of high_water keys and wait while it is full: get() takes a ready key,
+    so it only waits when keys are requested faster than the workers produce them.
+    close() terminates the workers, the keys they are generating are not needed
+    """
+    def __init__(self, e = 65537, modulus_length = 2048, nprimes = 2, high_water = 8, workers = None) -> None:
+        self.params = (e, modulus_length, nprimes)
+        self.high_water = high_water
+        self.keys = multiprocessing.Queue(high_water)
+        self.failed = False
+        self.closed = False
+        self.processes = [multiprocessing.Process(target=_key_worker, args=(self.params, self.keys), daemon=True)
+                          for _ in range(workers or os.cpu_count() or 1)]
+        for process in self.processes:
+            process.start()
+
+    def get(self):
+        """ Return a ready private key [N, d, p, q, dP, dQ, qInv, others], or wait for the next one """
+        if self.closed:
+            raise ValueError("The key pool is closed")
+        while not self.failed:
+            try:
+                key = self.keys.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    break
+                continue
+            if not isinstance(key, Exception):
+                return key
+            self.failed = True
+        # The workers failed: generate here, which raises the error if there is one
+        return generate_keypair(*self.params)
+
+    def close(self):
+        self.closed = True
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.keys.close()
+
+
+_key_pools = {}
+_key_pools_lock = threading.Lock()
+
+def key_pool(e = 65537, modulus_length = 2048, nprimes = 2, high_water = 8):
+    """ The shared RSAKeyPool for these parameters, started on first use """
+    with _key_pools_lock:
+        pool = _key_pools.get((e, modulus_length, nprimes))
+        if pool is None:
+            pool = _key_pools[(e, modulus_length, nprimes)] = RSAKeyPool(e, modulus_length, nprimes, high_water)
+        return pool
+
+@atexit.register
+def close_key_pools():
+    with _key_pools_lock:
+        pools = list(_key_pools.values())
+        _key_pools.clear()
+    for pool in pools:
+        pool.close()
+
+class RSACipher_Impl:
+    # Public e could be 3 or 65537 (=2^16 + 1). Modulus must be at least 2048
+    # With nprimes = 3 or 4 the modulus is a multi-prime one (RFC 8017), decryption is then faster still
+    # With use_pool the key is taken from the shared key_pool of these parameters instead of generated on the spot
+    def __init__(self, e = 65537, modulus_length = 2048, nprimes = 2, use_pool = True) -> None:
+        if nprimes not in (2, 3, 4):
+            raise ValueError("The modulus must have 2, 3 or 4 prime factors")
+        self.e, self.modulus_length, self.nprimes = e, modulus_length, nprimes
+        # [N, d, p, q, dP, dQ, qInv, others]
+        self.private_keys = key_pool(e, modulus_length, nprimes).get() if use_pool else self.generate_keys()
+        self.public_keys = [self.private_keys[0], e]
+
+
+    def generate_keys(self):
+        return generate_keypair(self.e, self.modulus_length, self.nprimes)
 
-        return [N, d]
-    
     def get_publickeys(self):
         return self.public_keys
     
@@ -76,10 +217,14 @@ class RSACipher_Impl:
         
 
     def decrypt(self, ciphertext):
-        N, d = self.private_keys
+        N, d = self.private_keys[:2]
+        e = self.public_keys[1]
         # Convert ciphertext bytes to int 
         cipher_int = int.from_bytes(ciphertext, byteorder='big')
-        decrypted_int = pow(cipher_int, d, N)
+        decrypted_int = crt_pow(cipher_int, self.private_keys[2:])
+        # A fault in one of the CRT exponentiations would leak a factor of N: check by re-encryption
+        if pow(decrypted_int, e, N) != cipher_int % N:
+            decrypted_int = pow(cipher_int, d, N)
         padded_plaintext = decrypted_int.to_bytes((decrypted_int.bit_length() + 7) // 8, 'big') #.decode('utf-8', "ignore") 
 
         # Add one byte '\x00' to the padded plaintext as leading 0 was ignored during int operations
@@ -87,9 +232,10 @@ class RSACipher_Impl:
 
 
 if __name__ == '__main__':
+    from time import perf_counter, sleep
+
     txt = "This is RSA cryptosystem!"
     rsa = RSACipher_Impl()
-    rsa.generate_keys()
     N, e = rsa.get_publickeys()
     print("Public keys:\ne = ", e, "\nN = ", N, "\n")
 
@@ -100,3 +246,42 @@ if __name__ == '__main__':
     plaintext = rsa.decrypt(ciphertext)
 
     print("Plaintext:", plaintext)
+    assert plaintext == txt
+
+    # Decryption with the full exponent, with the CRT and with multi-prime moduli
+    count = 50
+    for nprimes in (2, 3, 4):
+        rsa = RSACipher_Impl(nprimes=nprimes, use_pool=nprimes == 2)
+        N, d = rsa.private_keys[:2]
+        assert N.bit_length() == rsa.modulus_length
+        c = int.from_bytes(rsa.encrypt(txt), 'big')
+        assert rsa.decrypt(rsa.encrypt(txt)) == txt and crt_pow(c, rsa.private_keys[2:]) == pow(c, d, N)
+        start = perf_counter()
+        for _ in range(count):
+            pow(c, d, N)
+        middle = perf_counter()
+        for _ in range(count):
+            crt_pow(c, rsa.private_keys[2:])
+        end = perf_counter()
+        print("{} primes: full exponent {:.2f} ms, CRT {:.2f} ms".format(nprimes, 1000 * (middle - start) / count, 1000 * (end - middle) / count))
+
+    # Key generation on the spot, and keys taken from the pool once it has filled up
+    start = perf_counter()
+    for _ in range(5):
+        generate_keypair(65537, 2048)
+    print("Key generation: {:.0f} ms".format(1000 * (perf_counter() - start) / 5))
+    pool = key_pool()
+    while not pool.keys.full():
+        sleep(0.1)
+    start = perf_counter()
+    ciphers = [RSACipher_Impl() for _ in range(pool.high_water)]
+    print("RSACipher_Impl from the key pool: {:.3f} ms".format(1000 * (perf_counter() - start) / len(ciphers)))
+
+    # A short-lived process does not wait at exit for the keys it will never use
+    import subprocess
+    start = perf_counter()
+    subprocess.run([sys.executable, "-c", "from Asymmetric.rsa_impl import RSACipher_Impl; RSACipher_Impl()"], check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    elapsed = perf_counter() - start
+    print("Process building one RSACipher_Impl: {:.2f} s".format(elapsed))
+    assert elapsed < 5
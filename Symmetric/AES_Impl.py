@@ -1,6 +1,10 @@
 """
-Implementation of AES in python, secure against side-channel analysys
+Implementation of AES in python.
+The cipher works on the state as four 32-bit column words with precomputed T-tables, which merge SubBytes,
+ShiftRows and MixColumns into four table lookups per column. Table lookups depend on secret data, so this
+implementation is NOT protected against cache-timing side-channel analysis.
 """
+from functools import lru_cache
 s_box = (
     0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67, 0x2B, 0xFE, 0xD7, 0xAB, 0x76,
     0xCA, 0x82, 0xC9, 0x7D, 0xFA, 0x59, 0x47, 0xF0, 0xAD, 0xD4, 0xA2, 0xAF, 0x9C, 0xA4, 0x72, 0xC0,
@@ -78,23 +82,18 @@ mul_03 = (
     0x0b, 0x08, 0x0d, 0x0e, 0x07, 0x04, 0x01, 0x02, 0x13, 0x10, 0x15, 0x16, 0x1f, 0x1c, 0x19, 0x1a
 )
 
-def padding(plaintext):
-    # Pad data to multiple block size under PKCS#7 standard
-    pt_bytes = plaintext.encode(encoding='uft-8')
-    padding_len = 16 - (len(plaintext) % 16)
-    return pt_bytes + bytes([padding_len] * padding_len)
-
 def unpadding(padded_data):
-    if len(padded_data) % 16 != 0:
+    # Remove the PKCS#7 padding, applied by AES_Impl.finalize
+    if len(padded_data) == 0 or len(padded_data) % 16 != 0:
         raise ValueError("Invalid PKCS#7 padding.")
-     
+
     padding_length = padded_data[-1]
-    assert padding_length > 0
-    pad = padded_data[-padding_length:]
-    assert all(padding_length == x for x in pad)
+    if not 0 < padding_length <= 16 or any(x != padding_length for x in padded_data[-padding_length:]):
+        raise ValueError("Invalid PKCS#7 padding.")
 
     return padded_data[:-padding_length]
-    
+
+# The helpers below are the textbook round functions, working on a state stored as 4 columns of 4 bytes: state[column][row]
 def sub_bytes(state):
     for i in range(4):
         for j in range(4):
@@ -114,26 +113,21 @@ def shift_rows(state):
     # Rotation-shift 3rd row by 3 position to the left
     state[0][3], state[1][3], state[2][3], state[3][3] = state[3][3], state[0][3], state[1][3], state[2][3]
 
-def mix_columns(state):    
-    """   
-    Mix state collumn. The four bytes of each column of the state are combined using an invertible linear transformation. 
+def mix_columns(state):
+    """
+    Mix state collumn. The four bytes of each column of the state are combined using an invertible linear transformation.
         [w]     [2  3  1  1]     [a]
         [x]  =  [1  2  3  1]  *  [b]
         [y]     [1  1  2  3]     [c]
         [z]     [3  1  1  2]     [d]
     """
-    temp = [0, 0, 0, 0]
-
-    for i in range(0, 16, 4):
-        temp[0] = state[i]
-        temp[1] = state[i+1]
-        temp[2] = state[i+2]
-        temp[3] = state[i+3]
+    for col in state:
+        a, b, c, d = col
 
-        state[i]	=	mul_02[temp[0]]	^ mul_03[temp[1]]   ^        temp[2]	^        temp[3]
-        state[i+1]	=	       temp[0]	^ mul_02[temp[1]]	^ mul_03[temp[2]]	^        temp[3]
-        state[i+2]	=	       temp[0]	^        temp[1]	^ mul_02[temp[2]]	^ mul_03[temp[3]]
-        state[i+3]	=	mul_03[temp[0]]	^        temp[1]	^        temp[2]	^ mul_02[temp[3]]
+        col[0]	=	mul_02[a]	^ mul_03[b]	^        c	^        d
+        col[1]	=	       a	^ mul_02[b]	^ mul_03[c]	^        d
+        col[2]	=	       a	^        b	^ mul_02[c]	^ mul_03[d]
+        col[3]	=	mul_03[a]	^        b	^        c	^ mul_02[d]
 
 
 def add_round_keys(state, key):
@@ -143,22 +137,264 @@ def add_round_keys(state, key):
             state[i][j] ^= key[i][j]
 
 
+def gf_mul(a, b):
+    # Multiply two bytes in GF(2^8) modulo the AES polynomial x^8 + x^4 + x^3 + x + 1
+    r = 0
+    while b:
+        if b & 1:
+            r ^= a
+        a = mul_02[a]
+        b >>= 1
+    return r
+
+def _ror8(w):
+    return ((w >> 8) | (w << 24)) & 0xFFFFFFFF
+
+# Encryption T-tables: Te0[x] is the column (2s, s, s, 3s) with s = S(x), Te1..Te3 are its byte rotations
+Te0 = tuple((mul_02[s] << 24) | (s << 16) | (s << 8) | mul_03[s] for s in s_box)
+Te1 = tuple(_ror8(w) for w in Te0)
+Te2 = tuple(_ror8(w) for w in Te1)
+Te3 = tuple(_ror8(w) for w in Te2)
+
+# Decryption T-tables: Td0[x] is the column (14s, 9s, 13s, 11s) with s = S^-1(x)
+Td0 = tuple((gf_mul(s, 14) << 24) | (gf_mul(s, 9) << 16) | (gf_mul(s, 13) << 8) | gf_mul(s, 11) for s in inv_s_box)
+Td1 = tuple(_ror8(w) for w in Td0)
+Td2 = tuple(_ror8(w) for w in Td1)
+Td3 = tuple(_ror8(w) for w in Td2)
+
+# S-boxes already shifted to each byte position of a word, for the last round
+S3, S2, S1 = tuple(s << 24 for s in s_box), tuple(s << 16 for s in s_box), tuple(s << 8 for s in s_box)
+IS3, IS2, IS1 = tuple(s << 24 for s in inv_s_box), tuple(s << 16 for s in inv_s_box), tuple(s << 8 for s in inv_s_box)
+
+rcon = (0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1B, 0x36)
+ROUNDS = {16: 10, 24: 12, 32: 14}
+
+
+def inv_mix_column_word(w):
+    # InvMixColumns of one column word. Td0[S(x)] is InvMixColumns of the column (x, 0, 0, 0)
+    return Td0[s_box[w >> 24]] ^ Td1[s_box[(w >> 16) & 0xFF]] ^ Td2[s_box[(w >> 8) & 0xFF]] ^ Td3[s_box[w & 0xFF]]
+
+@lru_cache(maxsize=64)
+def expand_key(key):
+    """
+    Expand an AES-128/192/256 key into the round key words of the cipher and of the equivalent inverse cipher.
+    The schedule is computed once per key and cached.
+    """
+    key = bytes(key)
+    if len(key) not in ROUNDS:
+        raise ValueError("AES key must be 16, 24 or 32 bytes long")
+    nk, nr = len(key) // 4, ROUNDS[len(key)]
+
+    w = [int.from_bytes(key[4*i:4*i + 4], 'big') for i in range(nk)]
+    for i in range(nk, 4 * (nr + 1)):
+        t = w[i - 1]
+        if i % nk == 0:
+            t = (t << 8 | t >> 24) & 0xFFFFFFFF         # RotWord
+            t = S3[t >> 24] | S2[(t >> 16) & 0xFF] | S1[(t >> 8) & 0xFF] | s_box[t & 0xFF]
+            t ^= rcon[i // nk - 1] << 24
+        elif nk > 6 and i % nk == 4:
+            t = S3[t >> 24] | S2[(t >> 16) & 0xFF] | S1[(t >> 8) & 0xFF] | s_box[t & 0xFF]
+        w.append(w[i - nk] ^ t)
+
+    # Inverse cipher keys: rounds in reverse order, InvMixColumns applied to the inner round keys
+    dw = []
+    for r in range(nr, -1, -1):
+        rk = w[4*r:4*r + 4]
+        dw += rk if r in (0, nr) else [inv_mix_column_word(x) for x in rk]
+    return nr, tuple(w), tuple(dw)
+
+
+def encrypt_block_words(s0, s1, s2, s3, nr, rk):
+    """ Encrypt the state given as four big-endian column words with the round keys rk """
+    s0 ^= rk[0]; s1 ^= rk[1]; s2 ^= rk[2]; s3 ^= rk[3]
+    k = 4
+    for _ in range(nr - 1):
+        t0 = Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 0xFF] ^ Te2[(s2 >> 8) & 0xFF] ^ Te3[s3 & 0xFF] ^ rk[k]
+        t1 = Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 0xFF] ^ Te2[(s3 >> 8) & 0xFF] ^ Te3[s0 & 0xFF] ^ rk[k + 1]
+        t2 = Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 0xFF] ^ Te2[(s0 >> 8) & 0xFF] ^ Te3[s1 & 0xFF] ^ rk[k + 2]
+        s3 = Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 0xFF] ^ Te2[(s1 >> 8) & 0xFF] ^ Te3[s2 & 0xFF] ^ rk[k + 3]
+        s0, s1, s2 = t0, t1, t2
+        k += 4
+
+    # Last round has no MixColumns
+    return (S3[s0 >> 24] | S2[(s1 >> 16) & 0xFF] | S1[(s2 >> 8) & 0xFF] | s_box[s3 & 0xFF]) ^ rk[k], \
+           (S3[s1 >> 24] | S2[(s2 >> 16) & 0xFF] | S1[(s3 >> 8) & 0xFF] | s_box[s0 & 0xFF]) ^ rk[k + 1], \
+           (S3[s2 >> 24] | S2[(s3 >> 16) & 0xFF] | S1[(s0 >> 8) & 0xFF] | s_box[s1 & 0xFF]) ^ rk[k + 2], \
+           (S3[s3 >> 24] | S2[(s0 >> 16) & 0xFF] | S1[(s1 >> 8) & 0xFF] | s_box[s2 & 0xFF]) ^ rk[k + 3]
+
+def decrypt_block_words(s0, s1, s2, s3, nr, dk):
+    """ Decrypt the state given as four big-endian column words with the inverse cipher round keys dk """
+    s0 ^= dk[0]; s1 ^= dk[1]; s2 ^= dk[2]; s3 ^= dk[3]
+    k = 4
+    for _ in range(nr - 1):
+        t0 = Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 0xFF] ^ Td2[(s2 >> 8) & 0xFF] ^ Td3[s1 & 0xFF] ^ dk[k]
+        t1 = Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 0xFF] ^ Td2[(s3 >> 8) & 0xFF] ^ Td3[s2 & 0xFF] ^ dk[k + 1]
+        t2 = Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 0xFF] ^ Td2[(s0 >> 8) & 0xFF] ^ Td3[s3 & 0xFF] ^ dk[k + 2]
+        s3 = Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 0xFF] ^ Td2[(s1 >> 8) & 0xFF] ^ Td3[s0 & 0xFF] ^ dk[k + 3]
+        s0, s1, s2 = t0, t1, t2
+        k += 4
+
+    return (IS3[s0 >> 24] | IS2[(s3 >> 16) & 0xFF] | IS1[(s2 >> 8) & 0xFF] | inv_s_box[s1 & 0xFF]) ^ dk[k], \
+           (IS3[s1 >> 24] | IS2[(s0 >> 16) & 0xFF] | IS1[(s3 >> 8) & 0xFF] | inv_s_box[s2 & 0xFF]) ^ dk[k + 1], \
+           (IS3[s2 >> 24] | IS2[(s1 >> 16) & 0xFF] | IS1[(s0 >> 8) & 0xFF] | inv_s_box[s3 & 0xFF]) ^ dk[k + 2], \
+           (IS3[s3 >> 24] | IS2[(s2 >> 16) & 0xFF] | IS1[(s1 >> 8) & 0xFF] | inv_s_box[s0 & 0xFF]) ^ dk[k + 3]
+
+
+M32 = 0xFFFFFFFF
+
 class AES_Impl:
-    def __init__(self) -> None:
-        pass
-    
-    
-    def update(self):
-        pass 
+    """
+    AES block cipher. Besides the one-shot encrypt/decrypt (ECB on whole blocks), it works as a stream:
+    update()/update_into() take bytes, bytearray or memoryview data of any length, encrypt or decrypt every
+    complete block straight from the caller's buffer and only keep the trailing partial block (at most 16 bytes).
+    PKCS#7 padding is added or checked by finalize(), after which the object can process a new message.
+    """
+    def __init__(self, key, decrypting=False, padding=True) -> None:
+        """ key must be 16, 24 or 32 bytes long for AES-128, AES-192 or AES-256 """
+        self.rounds, self.enc_keys, self.dec_keys = expand_key(bytes(key))
+        self.decrypting, self.padding = decrypting, padding
+        self._buf = bytearray()
+
+    def _crypt_block(self, src, dst, decrypt):
+        # Encrypt or decrypt the 16 bytes of src into the 16 bytes of dst, both bytes-like objects
+        x = int.from_bytes(src, 'big')
+        if decrypt:
+            s0, s1, s2, s3 = decrypt_block_words(x >> 96, (x >> 64) & M32, (x >> 32) & M32, x & M32, self.rounds, self.dec_keys)
+        else:
+            s0, s1, s2, s3 = encrypt_block_words(x >> 96, (x >> 64) & M32, (x >> 32) & M32, x & M32, self.rounds, self.enc_keys)
+        dst[:16] = (s0 << 96 | s1 << 64 | s2 << 32 | s3).to_bytes(16, 'big')
+
+    def encrypt_block(self, block):
+        out = bytearray(16)
+        self._crypt_block(block, out, False)
+        return bytes(out)
+
+    def decrypt_block(self, block):
+        out = bytearray(16)
+        self._crypt_block(block, out, True)
+        return bytes(out)
+
+    def update_into(self, data, out):
+        """
+        Process data and write the result into the writable buffer out, which must hold at least 15 bytes more than data.
+        Return the number of bytes written
+        """
+        src = memoryview(data).cast('B')
+        dst = memoryview(out).cast('B')
+        if len(dst) < len(src) + 15:
+            raise ValueError("Output buffer must be at least {} bytes".format(len(src) + 15))
+
+        # A decrypted final block may be padding, so it stays buffered until finalize
+        total = len(self._buf) + len(src)
+        keep = total % 16
+        if keep == 0 and total and self.decrypting and self.padding:
+            keep = 16
+        todo = total - keep
+
+        i = j = 0
+        if self._buf and todo:
+            i = 16 - len(self._buf)
+            self._buf += src[:i]
+            self._crypt_block(self._buf, dst, self.decrypting)
+            self._buf.clear()
+            j, todo = 16, todo - 16
+        while todo:
+            self._crypt_block(src[i:i + 16], dst[j:j + 16], self.decrypting)
+            i, j, todo = i + 16, j + 16, todo - 16
+        self._buf += src[i:]
+        return j
+
+    def update(self, data):
+        out = bytearray(memoryview(data).nbytes + 15)
+        n = self.update_into(data, out)
+        return bytes(out[:n])
 
     def finalize(self):
-        pass 
+        """ Add (encryption) or check and remove (decryption) the PKCS#7 padding of the last block """
+        buf, self._buf = self._buf, bytearray()
+        if not self.padding:
+            if buf:
+                raise ValueError("Data length is not a multiple of 16 bytes")
+            return b''
+        if self.decrypting:
+            if len(buf) != 16:
+                raise ValueError("Invalid PKCS#7 padding.")
+            return unpadding(self.decrypt_block(buf))
+        padding_len = 16 - len(buf)
+        return self.encrypt_block(buf + bytes([padding_len] * padding_len))
 
     def encrypt(self, pt):
-        pass
+        # Encrypt each 16-byte block independently (ECB)
+        if len(pt) % 16:
+            raise ValueError("Plaintext length must be a multiple of 16 bytes")
+        return b''.join(self.encrypt_block(pt[i:i + 16]) for i in range(0, len(pt), 16))
 
     def decrypt(self, ct):
-        pass 
+        if len(ct) % 16:
+            raise ValueError("Ciphertext length must be a multiple of 16 bytes")
+        return b''.join(self.decrypt_block(ct[i:i + 16]) for i in range(0, len(ct), 16))
+
+
+def crypt_stream(cipher, fin, fout, chunk_size=1 << 16):
+    """
+    Feed the file-like object fin through the AES_Impl stream cipher into fout with fixed memory:
+    one input and one output buffer of chunk_size bytes are reused for the whole stream
+    """
+    inbuf = bytearray(chunk_size)
+    outbuf = bytearray(chunk_size + 15)
+    view = memoryview(inbuf)
+    while True:
+        n = fin.readinto(inbuf)
+        if not n:
+            break
+        fout.write(memoryview(outbuf)[:cipher.update_into(view[:n], outbuf)])
+    fout.write(cipher.finalize())
 
 if __name__ == '__main__':
-    pass 
\ No newline at end of file
+    import os
+    from time import perf_counter
+
+    # FIPS-197, Appendix C
+    pt = bytes.fromhex('00112233445566778899aabbccddeeff')
+    vectors = (
+        ('000102030405060708090a0b0c0d0e0f', '69c4e0d86a7b0430d8cdb78070b4c55a'),
+        ('000102030405060708090a0b0c0d0e0f1011121314151617', 'dda97ca4864cdfe06eaf70a0ec0d7191'),
+        ('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f', '8ea2b7ca516745bfeafc49904b496089'),
+    )
+    for key, ct in vectors:
+        aes = AES_Impl(bytes.fromhex(key))
+        assert aes.encrypt_block(pt).hex() == ct
+        assert aes.decrypt_block(bytes.fromhex(ct)) == pt
+    print("FIPS-197 test vectors: OK")
+
+    # Compare with AES of the cryptography package
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives import padding
+    for keylen in (16, 24, 32):
+        key, data = os.urandom(keylen), os.urandom(16 * 64)
+        encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+        assert AES_Impl(key).encrypt(data) == encryptor.update(data) + encryptor.finalize()
+        assert AES_Impl(key).decrypt(AES_Impl(key).encrypt(data)) == data
+    print("Same results as cryptography: OK")
+
+    # Streaming: chunks of any size give the same result as one call, with PKCS#7 padding
+    import io
+    key, data = os.urandom(16), os.urandom(1000)
+    padder = padding.PKCS7(128).padder()
+    expected = AES_Impl(key).encrypt(padder.update(data) + padder.finalize())
+    enc = AES_Impl(key)
+    ct = b''.join(enc.update(memoryview(data)[i:i + 37]) for i in range(0, len(data), 37)) + enc.finalize()
+    assert ct == expected
+    fout = io.BytesIO()
+    crypt_stream(AES_Impl(key, decrypting=True), io.BytesIO(ct), fout, chunk_size=64)
+    assert fout.getvalue() == data
+    # A memoryview of items wider than a byte is taken as its bytes
+    from array import array
+    words = array('I', range(8))
+    assert AES_Impl(key).update(memoryview(words)) == AES_Impl(key).update(words.tobytes())
+    print("Streaming update/finalize: OK")
+
+    aes, data = AES_Impl(os.urandom(16)), os.urandom(16 * 20000)
+    start = perf_counter()
+    aes.encrypt(data)
+    print("AES-128: {:.0f} blocks per second".format(20000 / (perf_counter() - start)))
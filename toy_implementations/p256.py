@@ -1,7 +1,17 @@
 import os 
+import sys
+import mmap
+import hashlib
+from functools import lru_cache
 from math import gcd 
 import random
 
+try:
+    from toy_implementations.p256_field import fe_add, fe_sub, fe_mul, fe_sqr, FIELD_REDUCTION
+except ImportError:
+    # Run as a script: python p256.py [table|bench]
+    from p256_field import fe_add, fe_sub, fe_mul, fe_sqr, FIELD_REDUCTION
+
 p = 115792089210356248762697446949407573530086143415290314195533631308867097853951
 a = -3
 b = 41058363725152142129326129780047268409114441015993725554835256314039467401291
@@ -54,14 +64,9 @@ def mod_inv_ct(x, m):
 
     return mod_pow(x, m - 2, m)
 
-def mod_add(x, y):
-    return mod(x + y)
-
-def mod_sub(x, y):
-    return mod(x - y)
-
-def mod_mul(x, y):
-    return mod(x*y)
+# Field operations of p256_field, bound to the reduction selected by P256_FIELD_REDUCTION.
+# Operands of mod_add and mod_sub are reduced, or small constants such as a
+mod_add, mod_sub, mod_mul, mod_sqr = fe_add, fe_sub, fe_mul, fe_sqr
 
 def mod_neg(x):
     return p - mod(x)
@@ -85,7 +90,7 @@ def pt_dbl(P):
     # lambda = (3x^2 + a)/2y
     x, y = P
     t1 = mod_mul(x, x)
-    t1 = mod_mul(3, x)
+    t1 = mod_mul(3, t1)
     t1 = mod_add(t1, a)
     t2 = mod_mul(2, y)
     t2 = mod_inv(t2)
@@ -167,70 +172,584 @@ def add(Q1, Q2):
 
     return x3, y3
 
-def scalar_mult(d, Q):
-    # Regular right-to-left scalar multiplication 
-    if d == 0:
+# Jacobian coordinates: (X, Y, Z) stands for the affine point (X/Z^2, Y/Z^3), Z = 0 for the point at infinity.
+# Additions and doublings need no inversion, a single one is done when converting the result back to affine.
+JO = (1, 1, 0)
+
+def to_jacobian(P):
+    if P == O:
+        return JO
+    return P[0], P[1], 1
+
+def to_affine(J):
+    X, Y, Z = J
+    if Z == 0:
         return O
-    """
-    R0, R1 = O, O       # R1 returns the result 
-    while d > 0:
-        bit = d * 1 
-        R0, R1 = (R0, pt_add(R1, P)) if bit else (pt_add(R0, P), R1)
-        P = pt_dbl(P)
-        d >>= 1
+    zinv = mod_inv(Z)
+    zinv2 = mod_sqr(zinv)
+    return mod_mul(X, zinv2), mod_mul(Y, mod_mul(zinv2, zinv))
 
-    return R1
+def mod_inv_batch(xs):
     """
-    R = O
+    Montgomery's simultaneous inversion: invert every element of xs modulo p with one inversion and 3(n - 1)
+    multiplications. Zero elements have no inverse and are returned as 0
+    """
+    prefix = []
+    acc = 1
+    for x in xs:
+        prefix.append(acc)
+        if x:
+            acc = mod_mul(acc, x)
+    inv = mod_inv(acc)
+    res = [0] * len(xs)
+    for i in range(len(xs) - 1, -1, -1):
+        if xs[i]:
+            res[i] = mod_mul(inv, prefix[i])
+            inv = mod_mul(inv, xs[i])
+    return res
+
+def normalize_batch(points):
+    # Convert a list of Jacobian points to affine coordinates with a single inversion
+    zinvs = mod_inv_batch([Z for _, _, Z in points])
+    res = []
+    for (X, Y, Z), zinv in zip(points, zinvs):
+        if Z == 0:
+            res.append(O)
+            continue
+        zinv2 = mod_sqr(zinv)
+        res.append((mod_mul(X, zinv2), mod_mul(Y, mod_mul(zinv2, zinv))))
+    return res
+
+def jac_dbl(J):
+    # dbl-2001-b, using a = -3: 3X^2 + aZ^4 = 3(X - Z^2)(X + Z^2)
+    X, Y, Z = J
+    if Z == 0 or Y == 0:
+        return JO
+    delta = mod_sqr(Z)
+    gamma = mod_sqr(Y)
+    beta = mod_mul(X, gamma)
+    alpha = mod_mul(3, mod_mul(mod_sub(X, delta), mod_add(X, delta)))
+    X3 = mod_sub(mod_sqr(alpha), mod_mul(8, beta))
+    Z3 = mod_sub(mod_sub(mod_sqr(mod_add(Y, Z)), gamma), delta)
+    Y3 = mod_sub(mod_mul(alpha, mod_sub(mod_mul(4, beta), X3)), mod_mul(8, mod_sqr(gamma)))
+    return X3, Y3, Z3
+
+def jac_add(J1, J2):
+    # add-2007-bl, falls back to doubling when both points are equal
+    X1, Y1, Z1 = J1
+    X2, Y2, Z2 = J2
+    if Z1 == 0:
+        return J2
+    if Z2 == 0:
+        return J1
+
+    Z1Z1 = mod_sqr(Z1)
+    Z2Z2 = mod_sqr(Z2)
+    U1 = mod_mul(X1, Z2Z2)
+    U2 = mod_mul(X2, Z1Z1)
+    S1 = mod_mul(Y1, mod_mul(Z2, Z2Z2))
+    S2 = mod_mul(Y2, mod_mul(Z1, Z1Z1))
+    H = mod_sub(U2, U1)
+    r = mod_sub(S2, S1)
+    if H == 0:
+        return jac_dbl(J1) if r == 0 else JO
+
+    HH = mod_sqr(H)
+    HHH = mod_mul(H, HH)
+    V = mod_mul(U1, HH)
+    X3 = mod_sub(mod_sub(mod_sqr(r), HHH), mod_add(V, V))
+    Y3 = mod_sub(mod_mul(r, mod_sub(V, X3)), mod_mul(S1, HHH))
+    Z3 = mod_mul(mod_mul(Z1, Z2), H)
+    return X3, Y3, Z3
+
+def jac_add_affine(J, P):
+    # Mixed addition of a Jacobian point J and an affine point P (madd-2004-hmv), saves the products by Z2 = 1
+    X1, Y1, Z1 = J
+    if P == O:
+        return J
+    if Z1 == 0:
+        return to_jacobian(P)
+    x2, y2 = P
+
+    Z1Z1 = mod_sqr(Z1)
+    U2 = mod_mul(x2, Z1Z1)
+    S2 = mod_mul(y2, mod_mul(Z1, Z1Z1))
+    H = mod_sub(U2, X1)
+    r = mod_sub(S2, Y1)
+    if H == 0:
+        return jac_dbl(J) if r == 0 else JO
+
+    HH = mod_sqr(H)
+    HHH = mod_mul(H, HH)
+    V = mod_mul(X1, HH)
+    X3 = mod_sub(mod_sub(mod_sqr(r), HHH), mod_add(V, V))
+    Y3 = mod_sub(mod_mul(r, mod_sub(V, X3)), mod_mul(Y1, HHH))
+    Z3 = mod_mul(Z1, H)
+    return X3, Y3, Z3
+
+def scalar_mult(d, Q):
+    # Left-to-right double-and-add in Jacobian coordinates, with mixed additions of the affine point Q
+    if d == 0 or Q == O:
+        return O
+
+    R = JO
+    for i in range(length(d) - 1, -1, -1):
+        R = jac_dbl(R)
+        if (d >> i) & 1:
+            R = jac_add_affine(R, Q)
 
+    return to_affine(R)
+
+def wnaf(d, w):
+    """ Width-w NAF of d, least significant digit first: digits are 0 or odd with |digit| < 2^(w-1) """
+    digits = []
     while d > 0:
         if d & 1:
-            R = add(R, Q)
-        Q = add(Q, Q)
-        d = (d >> 1)
+            k = d & ((1 << w) - 1)
+            if k >= 1 << (w - 1):
+                k -= 1 << w
+            d -= k
+        else:
+            k = 0
+        digits.append(k)
+        d >>= 1
+    return digits
+
+def jac_neg(J):
+    X, Y, Z = J
+    return X, mod_neg(Y) if Y else 0, Z
+
+def odd_multiples(P, w):
+    # P, 3P, ..., (2^(w-1) - 1)P in Jacobian coordinates
+    J = to_jacobian(P)
+    P2 = jac_dbl(J)
+    odd = [J]
+    for _ in range((1 << (w - 2)) - 1):
+        odd.append(jac_add(odd[-1], P2))
+    return odd
+
+def wnaf_mult(d, P, w=5):
+    """
+    Variable-base scalar multiplication with the width-w NAF of d: a table of the odd multiples
+    P, 3P, ..., (2^(w-1) - 1)P is built for the call, then about 256/(w+1) additions are done instead of 128
+    """
+    d %= n
+    if d == 0 or P == O:
+        return O
 
-    return R
+    odd = odd_multiples(P, w)
+    R = JO
+    for k in reversed(wnaf(d, w)):
+        R = jac_dbl(R)
+        if k > 0:
+            R = jac_add(R, odd[k >> 1])
+        elif k < 0:
+            R = jac_add(R, jac_neg(odd[-k >> 1]))
+    return to_affine(R)
 
 # Scalar multiplication due to Montgomery ladder 
 def montgomery_ladder(d, P):
     if d == 0:
         return O
     
-    R0, R1 = O, P
+    R0, R1 = JO, to_jacobian(P)
     for i in range(length(d), 0, -1):
         bit = (d >> (i - 1)) & 1        
-        R0, R1 = (pt_add(R0, R1), pt_dbl(R1)) if bit else (pt_dbl(R0), pt_add(R0, R1))
+        R0, R1 = (jac_add(R0, R1), jac_dbl(R1)) if bit else (jac_dbl(R0), jac_add(R0, R1))
     
-    #assert R1 == pt_add(R0, P)    
-    return R0
+    return to_affine(R0)
+
+# Fixed-base table of G: row i holds j * 2^(w*i) * G in affine coordinates for 1 <= j < 2^w.
+# d * G is then the sum of one entry per w-bit digit of d: ceil(256/w) mixed additions and no doubling.
+# Table lookups depend on the digits of d, the table is not meant to resist cache-timing attacks.
+G_WINDOW = 8
+G_TABLE_PATH = os.environ.get("P256_G_TABLE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "p256_g.table"))
+G_TABLE_MAGIC = b"P256GTB2"
+
+class FixedBaseTable:
+    """
+    Precomputed multiples of an affine point P for fixed-base scalar multiplication.
+    Points are kept as 64-byte records x || y in a bytes-like buffer, which can be a memory-mapped file,
+    so that a table saved by one process is loaded by the next ones without any computation.
+    A saved table starts with G_TABLE_MAGIC, the window w and the SHA-256 of the records
+    """
+    def __init__(self, P, w, data):
+        self.P, self.w, self.data = P, w, data
+        self.rows = -(-length(n) // w)
+        self.cols = (1 << w) - 1
+
+    @classmethod
+    def build(cls, P, w=G_WINDOW):
+        points = []
+        base = to_jacobian(P)
+        for _ in range(-(-length(n) // w)):
+            R = base
+            for j in range(1, 1 << w):
+                points.append(R)
+                R = jac_add(R, base)
+            base = R                        # 2^w * base
+
+        data = bytearray()
+        for x, y in normalize_batch(points):
+            data += x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+        return cls(P, w, data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = len(G_TABLE_MAGIC) + 1 + 32
+        if len(data) < header or data[:len(G_TABLE_MAGIC)] != G_TABLE_MAGIC:
+            raise ValueError("{} is not a fixed-base table".format(path))
+        w = data[len(G_TABLE_MAGIC)]
+        if not 1 <= w <= 16:
+            raise ValueError("{} has an invalid window size".format(path))
+        digest = data[len(G_TABLE_MAGIC) + 1:header]
+        view = memoryview(data)[header:]
+        P = (int.from_bytes(view[:32], 'big'), int.from_bytes(view[32:64], 'big'))
+        table = cls(P, w, view)
+        if len(view) != 64 * table.rows * table.cols:
+            raise ValueError("{} is truncated".format(path))
+        if hashlib.sha256(view).digest() != digest:
+            raise ValueError("{} is corrupted".format(path))
+        return table
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            f.write(G_TABLE_MAGIC + bytes([self.w]) + hashlib.sha256(self.data).digest())
+            f.write(self.data)
+        os.replace(path + ".tmp", path)
+
+    def point(self, i, j):
+        # j * 2^(w*i) * P
+        off = 64 * (i * self.cols + j - 1)
+        return int.from_bytes(self.data[off:off + 32], 'big'), int.from_bytes(self.data[off + 32:off + 64], 'big')
+
+    def mult(self, d):
+        return to_affine(self.mult_jacobian(d))
+
+    def mult_jacobian(self, d):
+        d %= n
+        mask = (1 << self.w) - 1
+        R = JO
+        i = 0
+        while d:
+            j = d & mask
+            if j:
+                R = jac_add_affine(R, self.point(i, j))
+            d >>= self.w
+            i += 1
+        return R
+
+_g_table = None
+
+def g_table():
+    """ Table of G, mapped from G_TABLE_PATH if it was saved there, built in memory on first use otherwise """
+    global _g_table
+    if _g_table is None:
+        if os.path.exists(G_TABLE_PATH):
+            table = FixedBaseTable.load(G_TABLE_PATH)
+            if table.P != G:
+                raise ValueError("{} is not a table of G".format(G_TABLE_PATH))
+            # The checksum only covers the file: a few random records are checked against the ladder
+            for _ in range(2):
+                i, j = random.randrange(table.rows), random.randrange(1, table.cols + 1)
+                if table.point(i, j) != scalar_mult(j << (table.w * i), G):
+                    raise ValueError("{} is not a table of G".format(G_TABLE_PATH))
+            _g_table = table
+        else:
+            _g_table = FixedBaseTable.build(G)
+    return _g_table
+
+def save_g_table(path=G_TABLE_PATH):
+    g_table().save(path)
+
+def base_mult(d):
+    # d * G with the fixed-base table
+    return g_table().mult(d)
 
 # Generate a key pair 
 def genkey():
     # Get a random number as a private key
     d = os.urandom(32)          # 32 bytes <--> 256 bits key 
-    d = mod(int.from_bytes(d, 'big'))
-    P = montgomery_ladder(d, G)
+    d = int.from_bytes(d, 'big') % (n - 1) + 1
+    P = base_mult(d)
 
     return d, P
 
-def ecdh(dA, PubB):
-    Rshared = scalar_mult(dA, PubB) #montgomery_ladder(dA, PubB)
+def genkey_batch(count):
+    """
+    Generate count key pairs at once, e.g., for a pool of ephemeral keys: the public keys are computed
+    in Jacobian coordinates with the table of G and converted to affine together with one inversion
+    """
+    privs = [int.from_bytes(os.urandom(32), 'big') % (n - 1) + 1 for _ in range(count)]
+    table = g_table()
+    pubs = normalize_batch([table.mult_jacobian(d) for d in privs])
+    return list(zip(privs, pubs))
+
+def ecdh(dA, PubB, ladder=False, w=5):
+    # The peer key changes at every call: wNAF by default, the regular Montgomery ladder if ladder is True
+    Rshared = montgomery_ladder(dA, PubB) if ladder else wnaf_mult(dA, PubB, w)
     xshared = Rshared[0]
     return xshared.to_bytes(32, 'big')
 
 
-privA, PubA = genkey()
-privB, PubB = genkey()
+def sqrt_mod(x, m):
+    """
+    A square root of x modulo the odd prime m, or None if x is not a square.
+    For m = 3 mod 4, as the P-256 prime, it is x^((m + 1) / 4), otherwise Tonelli-Shanks.
+    The result is checked by squaring it, which replaces a separate Legendre symbol exponentiation
+    """
+    x %= m
+    if x == 0:
+        return 0
+    if m & 3 == 3:
+        y = pow(x, (m + 1) >> 2, m)
+        return y if y * y % m == x else None
+
+    # Tonelli-Shanks: m - 1 = q * 2^e with q odd
+    q, e = m - 1, 0
+    while q & 1 == 0:
+        q >>= 1
+        e += 1
+    z = 2
+    while pow(z, (m - 1) >> 1, m) != m - 1:
+        z += 1
+    c, y, t = pow(z, q, m), pow(x, (q + 1) >> 1, m), pow(x, q, m)
+    while t != 1:
+        # Least i with t^(2^i) = 1, there is none if x is not a square
+        i, t2 = 0, t
+        while t2 != 1:
+            t2 = t2 * t2 % m
+            i += 1
+            if i == e:
+                return None
+        b = pow(c, 1 << (e - i - 1), m)
+        y, c = y * b % m, b * b % m
+        t, e = t * c % m, i
+    return y
+
+def lift_x(x, parity):
+    # The point of abscissa x whose ordinate has the given parity, or None if there is none on the curve
+    if not 0 <= x < p:
+        return None
+    y = sqrt_mod(mod_add(mod_mul(mod_sqr(x), x), mod_add(mod_mul(a, x), b)), p)
+    if y is None:
+        return None
+    return (x, y) if y & 1 == parity & 1 else (x, mod_neg(y))
+
+def is_on_curve(P):
+    x, y = P
+    return 0 <= x < p and 0 <= y < p and mod_sqr(y) == mod_add(mod_mul(mod_sqr(x), x), mod_add(mod_mul(a, x), b))
+
+def encode_point(P, compressed=True):
+    """ SEC1 encoding: 0x02/0x03 || x when compressed, the prefix giving the parity of y, 0x04 || x || y otherwise """
+    if P == O:
+        return b'\x00'
+    x, y = P
+    if compressed:
+        return bytes([2 | (y & 1)]) + x.to_bytes(32, 'big')
+    return b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+# Number of decoded public keys kept by decode_point
+DECODED_KEYS_CACHE = 1024
+
+@lru_cache(maxsize=DECODED_KEYS_CACHE)
+def _decode_point(data):
+    if len(data) == 33 and data[0] in (2, 3):
+        P = lift_x(int.from_bytes(data[1:], 'big'), data[0])
+        if P is None:
+            raise ValueError("Invalid compressed point")
+        return P
+    if len(data) == 65 and data[0] == 4:
+        P = int.from_bytes(data[1:33], 'big'), int.from_bytes(data[33:], 'big')
+        if not is_on_curve(P):
+            raise ValueError("Point is not on the curve")
+        return P
+    raise ValueError("Invalid SEC1 point encoding")
+
+def decode_point(data):
+    """
+    Decode and validate a SEC1 encoded public key. The point at infinity is rejected.
+    Results are cached, peers tend to send the same keys again and again
+    """
+    return _decode_point(bytes(data))
+
+
+def multi_mult(terms):
+    """
+    Compute the sum of k * P over terms, a list of (k, odd, affine) where odd holds the odd multiples of P
+    for the width-w NAF of k (affine or Jacobian points). All terms are interleaved (Straus): the doublings are shared
+    """
+    digits = [(wnaf(k % n, w), odd, jac_add_affine if affine else jac_add,
+               (lambda Q: (Q[0], mod_neg(Q[1]))) if affine else jac_neg) for k, odd, affine, w in terms]
+    R = JO
+    for i in range(max((len(ds) for ds, _, _, _ in digits), default=0) - 1, -1, -1):
+        R = jac_dbl(R)
+        for ds, odd, addf, neg in digits:
+            if i < len(ds) and ds[i]:
+                k = ds[i]
+                R = addf(R, odd[k >> 1] if k > 0 else neg(odd[-k >> 1]))
+    return R
+
+# Width of the NAF of the scalars of G, its odd multiples are computed once and kept in affine coordinates
+G_NAF_WINDOW = 7
+_g_odd = None
+
+def g_odd_multiples():
+    global _g_odd
+    if _g_odd is None:
+        _g_odd = normalize_batch(odd_multiples(G, G_NAF_WINDOW))
+    return _g_odd
 
-sharedECDHA = ecdh(privA, PubB)
-sharedECDHB = ecdh(privB, PubA)
+def shamir_mult(u1, u2, Q, w=5):
+    # u1 * G + u2 * Q in a single pass of doublings
+    return to_affine(multi_mult([(u1, g_odd_multiples(), True, G_NAF_WINDOW), (u2, odd_multiples(Q, w), False, w)]))
 
-print(sharedECDHA)
-print(sharedECDHB)
-assert sharedECDHA == sharedECDHB
 
-#x, y = G
-#print(x)
-#print(y)
-#print(G)
+# ECDSA with SHA-256, a signature is (r, s), or (r, s, v) when the point R can be recovered from it
+def hash_msg(msg):
+    if isinstance(msg, str):
+        msg = msg.encode('utf-8')
+    return int.from_bytes(hashlib.sha256(msg).digest(), 'big') % n
 
+def sign(d, msg, recoverable=False):
+    """
+    Sign msg with the private key d. With recoverable, the signature also carries v, telling the parity
+    of the y coordinate of R and whether its x coordinate was reduced modulo n, used by verify_batch
+    """
+    e = hash_msg(msg)
+    while True:
+        k = int.from_bytes(os.urandom(32), 'big') % (n - 1) + 1
+        x, y = base_mult(k)
+        r = x % n
+        if r == 0:
+            continue
+        s = pow(k, -1, n) * (e + r * d) % n
+        if s == 0:
+            continue
+        if recoverable:
+            return r, s, (y & 1) | (2 if x >= n else 0)
+        return r, s
+
+def verify(Q, msg, sig):
+    """ Verify the signature of msg with the public key Q: u1 * G + u2 * Q is computed with Shamir's trick """
+    r, s = sig[0], sig[1]
+    if not (0 < r < n and 0 < s < n) or Q == O:
+        return False
+    w = pow(s, -1, n)
+    R = shamir_mult(hash_msg(msg) * w % n, r * w % n, Q)
+    return R != O and R[0] % n == r
+
+def recover_r(sig):
+    # The point R of a recoverable signature, or None if it is not on the curve
+    r, _, v = sig
+    return lift_x(r + (v >> 1) * n, v)
+
+def verify_batch(items):
+    """
+    Verify a list of (Q, msg, sig) at once. Recoverable signatures are checked together through a random
+    linear combination: with random 128-bit z_i, sum z_i (u1_i G + u2_i Q_i - R_i) must be the point at infinity.
+    The multiples of G are merged into one scalar and the whole sum is a single multi-scalar multiplication.
+    Signatures without v are verified one by one
+    """
+    terms = []
+    g_scalar = 0
+    for Q, msg, sig in items:
+        if len(sig) != 3:
+            if not verify(Q, msg, sig):
+                return False
+            continue
+        r, s, _ = sig
+        R = recover_r(sig)
+        if not (0 < r < n and 0 < s < n) or Q == O or R is None:
+            return False
+        w = pow(s, -1, n)
+        z = int.from_bytes(os.urandom(16), 'big') | 1
+        g_scalar += z * hash_msg(msg) * w
+        terms.append((z * r * w, odd_multiples(Q, 5), False, 5))
+        terms.append((n - z, odd_multiples(R, 4), False, 4))
+    if not terms:
+        return True
+    terms.append((g_scalar, g_odd_multiples(), True, G_NAF_WINDOW))
+    return multi_mult(terms)[2] == 0
+
+def benchmark(count=50):
+    # Compare the variable-base scalar multiplications
+    from time import perf_counter
+
+    print("Field reduction:", FIELD_REDUCTION)
+    _, P = genkey()
+    scalars = [int.from_bytes(os.urandom(32), 'big') % n for _ in range(count)]
+    methods = [("Montgomery ladder", montgomery_ladder), ("double-and-add", scalar_mult)]
+    methods += [("wNAF w={}".format(w), lambda d, P, w=w: wnaf_mult(d, P, w)) for w in (4, 5, 6)]
+    for name, f in methods:
+        start = perf_counter()
+        for d in scalars:
+            f(d, P)
+        print("{:>18}: {:.0f} ops/sec".format(name, count / (perf_counter() - start)))
+
+    # ECDSA verification: two separate scalar multiplications, Shamir's trick, batch verification
+    d, Q = genkey()
+    msgs = [os.urandom(32) for _ in range(count)]
+    sigs = [sign(d, m, recoverable=True) for m in msgs]
+
+    def naive_verify(Q, msg, sig):
+        r, s = sig[0], sig[1]
+        w = pow(s, -1, n)
+        R = add(scalar_mult(hash_msg(msg) * w % n, G), scalar_mult(r * w % n, Q))
+        return R[0] % n == r
+
+    for name, f in (("two scalar mults", lambda: all(naive_verify(Q, m, sg) for m, sg in zip(msgs, sigs))),
+                    ("Shamir's trick", lambda: all(verify(Q, m, sg) for m, sg in zip(msgs, sigs))),
+                    ("batch", lambda: verify_batch([(Q, m, sg) for m, sg in zip(msgs, sigs)]))):
+        start = perf_counter()
+        assert f()
+        print("{:>18}: {:.0f} verifications/sec".format(name, count / (perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'table':
+        save_g_table()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+
+    privA, PubA = genkey()
+    privB, PubB = genkey()
+
+    sharedECDHA = ecdh(privA, PubB)
+    sharedECDHB = ecdh(privB, PubA)
+
+    print(sharedECDHA)
+    print(sharedECDHB)
+    assert sharedECDHA == sharedECDHB
+
+    # SEC1 encodings
+    for P in (PubA, PubB):
+        assert decode_point(encode_point(P)) == P and decode_point(encode_point(P, compressed=False)) == P
+    assert len(encode_point(PubA)) == 33 and len(encode_point(PubA, compressed=False)) == 65
+
+    # A saved table is rejected once a record is changed
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "g.table")
+        save_g_table(path)
+        assert FixedBaseTable.load(path).mult(privA) == PubA
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+        try:
+            FixedBaseTable.load(path)
+            assert False
+        except ValueError:
+            pass
+        with open(path, "r+b") as f:
+            f.seek(len(G_TABLE_MAGIC))
+            f.write(b"\x00")
+        try:
+            FixedBaseTable.load(path)
+            assert False
+        except ValueError:
+            pass
@@ -0,0 +1,121 @@
+"""
+Field arithmetic modulo the P-256 prime p = 2^256 - 2^224 + 2^192 + 2^96 - 1.
+p is a generalized Mersenne prime, so a 512-bit product can be reduced with additions and subtractions of
+its 32-bit words (FIPS 186-4, D.2.3) instead of a division. Both reductions are implemented:
+- generic: Python's bigint x % p
+- solinas: the word-wise fast reduction
+p256.py uses fe_add, fe_sub, fe_mul and fe_sqr, bound to one of them by the P256_FIELD_REDUCTION environment variable.
+The default is generic: in CPython the word extraction is interpreted while % runs in C, so the fast reduction
+loses (about 6 us against 1 us per multiplication here, see benchmark()). It is kept for the comparison and as the
+reference for a port to fixed-width limbs.
+"""
+import os
+
+p = 115792089210356248762697446949407573530086143415290314195533631308867097853951
+
+M32 = 0xFFFFFFFF
+M256 = (1 << 256) - 1
+
+
+def solinas_reduce(c):
+    """ Reduce 0 <= c < 2^512 modulo p with the NIST fast reduction. Other values fall back to c % p """
+    if c < 0 or c >> 512:
+        return c % p
+    c8, c9, c10, c11 = (c >> 256) & M32, (c >> 288) & M32, (c >> 320) & M32, (c >> 352) & M32
+    c12, c13, c14, c15 = (c >> 384) & M32, (c >> 416) & M32, (c >> 448) & M32, c >> 480
+
+    # Words listed from the most significant one: (A7, ..., A0)
+    s2 = c15 << 224 | c14 << 192 | c13 << 160 | c12 << 128 | c11 << 96
+    s3 = c15 << 192 | c14 << 160 | c13 << 128 | c12 << 96
+    s4 = c15 << 224 | c14 << 192 | c10 << 64 | c9 << 32 | c8
+    s5 = c8 << 224 | c13 << 192 | c15 << 160 | c14 << 128 | c13 << 96 | c11 << 64 | c10 << 32 | c9
+    d1 = c10 << 224 | c8 << 192 | c13 << 64 | c12 << 32 | c11
+    d2 = c11 << 224 | c9 << 192 | c15 << 96 | c14 << 64 | c13 << 32 | c12
+    d3 = c12 << 224 | c10 << 160 | c9 << 128 | c8 << 96 | c15 << 64 | c14 << 32 | c13
+    d4 = c13 << 224 | c11 << 160 | c10 << 128 | c9 << 96 | c15 << 32 | c14
+
+    r = (c & M256) + ((s2 + s3) << 1) + s4 + s5 - d1 - d2 - d3 - d4
+    # -4p < r < 5p
+    while r >= p:
+        r -= p
+    while r < 0:
+        r += p
+    return r
+
+
+def fe_add_generic(x, y):
+    return (x + y) % p
+
+def fe_sub_generic(x, y):
+    return (x - y) % p
+
+# Additions and subtractions of reduced elements only need one conditional correction.
+# They also accept small negative constants such as a = -3
+def fe_add_conditional(x, y):
+    r = x + y
+    if r >= p:
+        return r - p
+    return r + p if r < 0 else r
+
+def fe_sub_conditional(x, y):
+    r = x - y
+    if r < 0:
+        return r + p
+    return r - p if r >= p else r
+
+def fe_neg(x):
+    return p - x if x else 0
+
+def fe_mul_generic(x, y):
+    return x * y % p
+
+def fe_sqr_generic(x):
+    return x * x % p
+
+def fe_mul_solinas(x, y):
+    return solinas_reduce(x * y)
+
+def fe_sqr_solinas(x):
+    return solinas_reduce(x * x)
+
+
+FIELD_REDUCTION = os.environ.get("P256_FIELD_REDUCTION", "generic")
+if FIELD_REDUCTION == "solinas":
+    fe_add, fe_sub, fe_mul, fe_sqr = fe_add_conditional, fe_sub_conditional, fe_mul_solinas, fe_sqr_solinas
+elif FIELD_REDUCTION == "generic":
+    fe_add, fe_sub, fe_mul, fe_sqr = fe_add_generic, fe_sub_generic, fe_mul_generic, fe_sqr_generic
+else:
+    raise ValueError("P256_FIELD_REDUCTION must be 'generic' or 'solinas'")
+
+
+def benchmark(count=100000):
+    # Time per field operation, for both reductions
+    from time import perf_counter
+
+    xs = [int.from_bytes(os.urandom(32), 'big') % p for _ in range(count)]
+    ys = [int.from_bytes(os.urandom(32), 'big') % p for _ in range(count)]
+    for x, y in zip(xs[:1000], ys):
+        assert fe_mul_solinas(x, y) == fe_mul_generic(x, y) and fe_sqr_solinas(x) == fe_sqr_generic(x)
+        assert fe_add_conditional(x, y) == fe_add_generic(x, y) and fe_sub_conditional(x, y) == fe_sub_generic(x, y)
+        assert fe_add_conditional(x, -3) == fe_add_generic(x, -3)
+    assert solinas_reduce((p - 1) ** 2) == 1 and solinas_reduce(M256 << 256 | M256) == (M256 << 256 | M256) % p
+
+    ops = (
+        ("add  generic", fe_add_generic),
+        ("add  conditional", fe_add_conditional),
+        ("sub  generic", fe_sub_generic),
+        ("sub  conditional", fe_sub_conditional),
+        ("mul  generic", fe_mul_generic),
+        ("mul  solinas", fe_mul_solinas),
+        ("sqr  generic", lambda x, y: fe_sqr_generic(x)),
+        ("sqr  solinas", lambda x, y: fe_sqr_solinas(x)),
+    )
+    for name, f in ops:
+        start = perf_counter()
+        for x, y in zip(xs, ys):
+            f(x, y)
+        print("{:>18}: {:.0f} ns".format(name, (perf_counter() - start) * 1e9 / count))
+
+
+if __name__ == '__main__':
+    benchmark()
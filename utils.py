@@ -1,5 +1,43 @@
+import os
+import sys
+import mmap
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from random import randint
-import numpy as np
+from math import gcd, isqrt
+from bisect import bisect_right
+from collections import OrderedDict
+from array import array
+
+
+def _sieve(bound):
+    """ Return the list of all primes below bound using the sieve of Eratosthenes """
+    flags = bytearray([1]) * bound
+    flags[:2] = b'\x00\x00'
+    for i in range(2, int(bound ** 0.5) + 1):
+        if flags[i]:
+            flags[i*i::i] = bytes(len(range(i*i, bound, i)))
+    return [i for i in range(bound) if flags[i]]
+
+
+# Small primes used to reject candidates before running Miller-Rabin
+SIEVE_BOUND = 1 << 16
+SMALL_PRIMES = _sieve(SIEVE_BOUND)
+_SMALL_PRIME_SET = frozenset(SMALL_PRIMES)
+
+# Product of the primes below 1024, a single gcd with it replaces ~170 trial divisions
+_TRIAL_BOUND = 1024
+_PRIMORIAL = 1
+for _q in SMALL_PRIMES:
+    if _q >= _TRIAL_BOUND:
+        break
+    _PRIMORIAL *= _q
+
+# Bases making Miller-Rabin deterministic for every n < 3317044064679887385961981 > 2^64
+_DETERMINISTIC_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+_DETERMINISTIC_LIMIT = 3317044064679887385961981
+
 
 def powmod(a, b, mod):
     """
@@ -20,21 +58,302 @@ def powmod(a, b, mod):
         b //= 2
     return r
 
-def isPrime(p):
-    """  Checking if p is a prime by using the observation that: p = 6k +/- 1 if p > 3 """
-    if p <= 3:
-        return p > 1
-    if p % 2 == 0 or p % 3 == 0:
-        return False
+class FixedBasePow:
+    """
+    Exponentiation g^e mod m for a fixed base g, with a table precomputed once:
+        table[i][d] = g^(d * 2^(w*i)) mod m,    0 <= d < 2^w
+    g^e is then the product of one table entry per w-bit digit of e, so that no squaring is needed.
+    The table grows if an exponent larger than bits is given
+    """
+    def __init__(self, g, mod, w=4, bits=None):
+        if mod < 2:
+            raise ValueError("Modulus must be at least 2")
+        self.g, self.mod, self.w = g % mod, mod, w
+        self.table = []
+        self._extend(bits if bits is not None else mod.bit_length())
+
+    def _extend(self, bits):
+        mod, w = self.mod, self.w
+        rows = -(-bits // w)
+        if self.table:
+            last = self.table[-1]
+            base = last[-1] * last[1] % mod         # g^(2^(w*i))
+        else:
+            base = self.g
+        while len(self.table) < rows:
+            row = [1, base]
+            for _ in range(2, 1 << w):
+                row.append(row[-1] * base % mod)
+            self.table.append(row)
+            base = row[-1] * base % mod
+
+    def nbytes(self):
+        """ Approximate size of the table in bytes """
+        return len(self.table) * (1 << self.w) * ((self.mod.bit_length() + 7) // 8)
+
+    def pow(self, e):
+        if e < 0:
+            return pow(self.pow(-e), -1, self.mod)
+        if e.bit_length() > len(self.table) * self.w:
+            self._extend(e.bit_length())
+
+        mod, mask = self.mod, (1 << self.w) - 1
+        r = 1
+        for row in self.table:
+            if e == 0:
+                break
+            d = e & mask
+            if d:
+                r = r * row[d] % mod
+            e >>= self.w
+        return r
+
+    __call__ = pow
+
+
+# Memory budget of the tables kept by fixedBasePowmod, least recently used tables are dropped first
+FIXED_BASE_CACHE_BYTES = 64 << 20
+_fixedBaseCache = OrderedDict()         # (g, mod) -> [table, size accounted in _fixedBaseCacheBytes]
+_fixedBaseCacheBytes = 0
+
+def getFixedBasePow(g, mod, bits=None):
+    """
+    Return the FixedBasePow table of (g, mod) from the LRU cache, building it if needed and extending it to
+    bits-bit exponents. Tables also grow in pow, so the size of a table is accounted again at every access
+    """
+    global _fixedBaseCacheBytes
+    key = (g % mod, mod)
+    entry = _fixedBaseCache.get(key)
+    if entry is None:
+        entry = _fixedBaseCache[key] = [FixedBasePow(g, mod), 0]
+    else:
+        _fixedBaseCache.move_to_end(key)
+    table = entry[0]
+    if bits is not None and bits > len(table.table) * table.w:
+        table._extend(bits)
+
+    size = table.nbytes()
+    _fixedBaseCacheBytes += size - entry[1]
+    entry[1] = size
+    if size > FIXED_BASE_CACHE_BYTES:
+        del _fixedBaseCache[key]
+        _fixedBaseCacheBytes -= size
+    while _fixedBaseCacheBytes > FIXED_BASE_CACHE_BYTES:
+        _, (_, oldSize) = _fixedBaseCache.popitem(last=False)
+        _fixedBaseCacheBytes -= oldSize
+    return table
+
+def fixedBasePowmod(a, b, mod):
+    """
+    Same as powmod(a, b, mod), for a base a reused across many calls, e.g., a group generator.
+    The first call with a given (a, mod) builds the table of FixedBasePow, the next ones only multiply
+    """
+    return getFixedBasePow(a, mod, abs(b).bit_length()).pow(b)
+
+def _digits(e, w, count):
+    """ Split e into count digits of w bits, least significant first """
+    mask = (1 << w) - 1
+    ds = []
+    for _ in range(count):
+        ds.append(e & mask)
+        e >>= w
+    return ds
+
+def _straus(bases, exps, mod, w):
+    """ Interleaved Straus: one table of 2^w powers per base, the squarings are shared by all terms """
+    mask = (1 << w) - 1
+    tables = []
+    for b in bases:
+        row = [1, b]
+        for _ in range(2, mask + 1):
+            row.append(row[-1] * b % mod)
+        tables.append(row)
+
+    windows = -(-max(e.bit_length() for e in exps) // w)
+    digits = [_digits(e, w, windows) for e in exps]
+    r = 1
+    for j in range(windows - 1, -1, -1):
+        if r != 1:
+            for _ in range(w):
+                r = r * r % mod
+        for row, ds in zip(tables, digits):
+            if ds[j]:
+                r = r * row[ds[j]] % mod
+    return r
 
-    sqrt = np.sqrt(p).astype(np.int64) + 1    
-    for i in filter(lambda x: x % 6 == 1 or x % 6 == 5, range(5, sqrt)):
-        if p % i == 0:
-            return False
+def _pippenger(bases, exps, mod, c):
+    """
+    Pippenger bucket method: for each window of c bits, bases are multiplied into the bucket of their digit d,
+    then prod B_d^d is obtained with 2 * 2^c multiplications by running products from the top bucket down
+    """
+    mask = (1 << c) - 1
+    windows = -(-max(e.bit_length() for e in exps) // c)
+    digits = [_digits(e, c, windows) for e in exps]
+    r = 1
+    for j in range(windows - 1, -1, -1):
+        if r != 1:
+            for _ in range(c):
+                r = r * r % mod
+        buckets = [1] * (mask + 1)
+        for b, ds in zip(bases, digits):
+            d = ds[j]
+            if d:
+                buckets[d] = buckets[d] * b % mod
+        running = acc = 1
+        for d in range(mask, 0, -1):
+            if buckets[d] != 1:
+                running = running * buckets[d] % mod
+            if running != 1:
+                acc = acc * running % mod
+        r = r * acc % mod
+    return r
+
+def multiPowmod(bases, exps, mod):
+    """
+    Compute the product of bases[i]^exps[i] mod m, e.g., to verify Schnorr proofs or ring signatures.
+    Interleaved Straus is used for a few terms and Pippenger's bucket method for many terms, the window sizes
+    and the switch between both come from their multiplication counts. All terms share the same squarings. Negative exponents use the inverse of their base
+    """
+    if len(bases) != len(exps):
+        raise ValueError("bases and exps must have the same length")
+    if mod < 2:
+        raise ValueError("Modulus must be at least 2")
+
+    bs, es = [], []
+    for b, e in zip(bases, exps):
+        if e < 0:
+            b, e = pow(b, -1, mod), -e
+        if e:
+            bs.append(b % mod)
+            es.append(e)
+    if not es:
+        return 1
+
+    # Number of multiplications: n tables of 2^w entries + n*bits/w for Straus,
+    # bits/c windows of n bucket insertions + 2^(c+1) to combine them for Pippenger
+    n, bits = len(es), max(e.bit_length() for e in es)
+    w = min(range(1, 8), key=lambda w: n * (1 << w) + n * bits // w)
+    c = min(range(1, 16), key=lambda c: -(-bits // c) * (n + (2 << c)))
+    if n * (1 << w) + n * bits // w <= -(-bits // c) * (n + (2 << c)):
+        return _straus(bs, es, mod, w)
+    return _pippenger(bs, es, mod, c)
 
+def mrRounds(bits):
+    """
+    Number of random Miller-Rabin bases for a randomly drawn candidate of the given bit size, to pass to isPrime.
+    Counts follow the OpenSSL table, giving an error probability below 2^-80 for random candidates only
+    """
+    if bits >= 3747: return 3
+    if bits >= 1345: return 4
+    if bits >= 476: return 5
+    if bits >= 400: return 6
+    if bits >= 347: return 7
+    if bits >= 308: return 8
+    if bits >= 55: return 27
+    return 34
+
+
+def _millerRabin(n, bases):
+    """ Run the Miller-Rabin test on an odd n > 3 for each base in bases """
+    # n - 1 = 2^s * d where d is odd
+    d = n - 1
+    s = (d & -d).bit_length() - 1
+    d >>= s
+
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
     return True
 
 
+def _jacobi(a, n):
+    """ Jacobi symbol (a / n) for an odd n > 0 """
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def _strongLucas(n):
+    """ Strong Lucas probable prime test of an odd n > 3 with no small factor, with Selfridge's parameters """
+    if isqrt(n) ** 2 == n:
+        return False
+    D = 5
+    while True:
+        j = _jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P, Q = 1, (1 - D) // 4
+
+    # n + 1 = 2^s * d where d is odd
+    d = n + 1
+    s = (d & -d).bit_length() - 1
+    d >>= s
+
+    # U_k, V_k and Q^k over the bits of d from the top
+    half = (n + 1) >> 1
+    U, V, Qk = 1, P, Q % n
+    for bit in bin(d)[3:]:
+        U, V, Qk = U * V % n, (V * V - 2 * Qk) % n, Qk * Qk % n
+        if bit == '1':
+            U, V, Qk = (P * U + V) * half % n, (D * U + P * V) * half % n, Qk * Q % n
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V, Qk = (V * V - 2 * Qk) % n, Qk * Qk % n
+        if V == 0:
+            return True
+    return False
+
+
+def isPrime(p, rounds=None):
+    """
+    Checking if p is a prime.
+    - p below SIEVE_BOUND is looked up in the small prime table, p below 2^32 in the prime bitmap if it was built
+    - p sharing a factor with the primes below 1024 is rejected by one gcd
+    - Miller-Rabin with a deterministic set of bases for p < 2^64 (and a bit beyond)
+    - above, base-2 Miller-Rabin and the strong Lucas test (BPSW), which no known composite passes.
+      Candidates drawn at random may pass rounds, e.g. mrRounds(bits): base 2 is then followed by rounds random bases
+    """
+    if p < SIEVE_BOUND:
+        return p in _SMALL_PRIME_SET
+    bitmap = primeBitmap()
+    if bitmap is not None and p < bitmap.limit:
+        return bitmap.isPrime(p)
+    if gcd(p, _PRIMORIAL) != 1:
+        return False
+    if p < _TRIAL_BOUND * _TRIAL_BOUND:
+        return True
+
+    if p < _DETERMINISTIC_LIMIT:
+        return _millerRabin(p, _DETERMINISTIC_BASES)
+
+    if not _millerRabin(p, (2,)):
+        return False
+    if rounds is None:
+        return _strongLucas(p)
+    return _millerRabin(p, [randint(3, p - 2) for _ in range(rounds)])
+
+
+
 def isFermatPrime(p, iter):
     """
     Checking if p is a probably prime. The simplest method is Fermat primality test.
@@ -49,105 +368,515 @@ def isFermatPrime(p, iter):
 
 
 def isMillerRabinPrime(p, iter):
-    """ Checking if p is a probably prime using Miller-Rabin primality test """
+    """ Checking if p is a probably prime using Miller-Rabin primality test with iter random bases """
     if p < 4:
         return p > 1
 
     if p % 2 == 0:
         return False
 
-    # now n is odd > 3
-    s = 0
-    d = p - 1
-    # p = 2^s * d where d is odd
-    while d % 2 == 0:
-        s += 1
-        d //= 2
-
-    for i in range(iter):
-        a = randint(2, p - 1)
-        x = (a**d) % p
-        if x == 1: continue
-        for j in range(s):
-            if x == p - 1: break
-            x = (x ** 2) % p
-        else:
-            return False
-    return True
+    # now p is odd > 3
+    return _millerRabin(p, [randint(2, p - 2) for _ in range(iter)])
 
-def nextPrime(n):
-    """ Calculate a prime p that is bigger than n using the fact that p = 6k +/- 1 """
 
-    if n <= 0:
-        return 2
-    elif n < 3:
-        return n + 1
+def sieveWindow(start, length):
+    """
+    Sieve the odd numbers start, start + 2, ..., start + 2*(length - 1) with SMALL_PRIMES.
+    start must be odd and at least SIEVE_BOUND. Return the offsets k such that start + 2k has no small factor
+    """
+    # Sieving further than about bits^2 costs more than the Miller-Rabin tests it saves
+    bound = min(SIEVE_BOUND, start.bit_length() ** 2)
 
-    if n % 6 == 0:
-        if isPrime(n + 1):
-            return n + 1
-        else:
-            p = n + 5
+    flags = bytearray([1]) * length
+    for q in SMALL_PRIMES[1:]:
+        if q >= bound:
+            break
+        # first k with start + 2k = 0 mod q, i.e., k = -start / 2 mod q
+        k = (-start * ((q + 1) >> 1)) % q
+        if k < length:
+            flags[k::q] = bytes(len(range(k, length, q)))
+    return [k for k in range(length) if flags[k]]
 
-    elif n % 6 == 5:
-        if isPrime(n + 2):
-            return n + 2
-        else:
-            p = n + 6
-    else:
-        p = n + (5 - (n % 6))
 
-    while not isPrime(p):
-        if isPrime(p + 2):
-            return p + 2
-        p += 6
-    return p
+def nextPrime(n):
+    """
+    Calculate the smallest prime p that is bigger than n.
+    Candidates are taken from windows of odd numbers sieved by SMALL_PRIMES, so that Miller-Rabin only runs on the survivors
+    """
+    if n < 2:
+        return 2
+    if n < SMALL_PRIMES[-1]:
+        p = n + 1
+        while p not in _SMALL_PRIME_SET:
+            p += 1
+        return p
+    bitmap = primeBitmap()
+    if bitmap is not None and n < bitmap.limit:
+        p = bitmap.nextPrime(n)
+        if p is not None:
+            return p
+
+    start = (n + 1) | 1
+    length = max(64, n.bit_length())
+    rounds = mrRounds(start.bit_length())
+    while True:
+        for k in sieveWindow(start, length):
+            if isPrime(start + 2*k, rounds):
+                return start + 2*k
+        start += 2*length
 
 def getPrime(b):
     """ Return a prime with b bits  """
-    n = randint(2**(b - 1), 2**b)
+    if b < 2:
+        raise ValueError("There is no prime with less than 2 bits")
+
+    while True:
+        p = nextPrime(randint(2**(b - 1), 2**b - 1))
+        if p.bit_length() == b:
+            return p
+
+# Bitmap of the odd primes below 2^32: bit i of the bitmap tells whether 2i + 1 is prime.
+# File layout: magic | limit (8 bytes) | cumulative prime count before each block (4 bytes each) | bitmap
+PRIME_BITMAP_PATH = os.environ.get("PRIME_BITMAP_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "primes.bitmap"))
+_BITMAP_MAGIC = b"PRIMEBM1"
+_BITMAP_BLOCK = 4096                    # bytes of bitmap per entry of the count index
+_BITMAP_SEGMENT = 1 << 23               # odd numbers sieved at once, a multiple of 8 * _BITMAP_BLOCK
+_BITS_TO_ASCII = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def buildPrimeBitmap(path=PRIME_BITMAP_PATH, limit=1 << 32):
+    """
+    Sieve the odd numbers below limit (at most 2^32) segment by segment and store the result in the bitmap file path,
+    together with a prime count index. It only has to be run once, PrimeBitmap then maps the file
+    """
+    if not 0 < limit <= 1 << 32:
+        raise ValueError("The prime bitmap covers numbers below 2^32")
+    odds = -(-limit // 2)
+    nbytes = -(-odds // 8)
+    nblocks = -(-nbytes // _BITMAP_BLOCK)
+    primes = [q for q in SMALL_PRIMES[1:] if q * q < limit]
+
+    counts = array("I")
+    count = 0
+    with open(path + ".tmp", "wb") as f:
+        f.write(_BITMAP_MAGIC + limit.to_bytes(8, "little"))
+        f.write(bytes(4 * nblocks))
+        for lo in range(0, odds, _BITMAP_SEGMENT):
+            # flags[k] is for the odd number 2(lo + k) + 1
+            length = min(_BITMAP_SEGMENT, odds - lo)
+            flags = bytearray([1]) * length
+            first = 2*lo + 1
+            if lo == 0:
+                flags[0] = 0                        # 1 is not a prime
+            for q in primes:
+                m = max(q * q, -(-first // q) * q)
+                if m % 2 == 0:
+                    m += q
+                k = (m - first) >> 1
+                if k < length:
+                    flags[k::q] = bytes(len(range(k, length, q)))
+            if length % 8:
+                flags += bytes(8 - length % 8)
+
+            bits = int(flags.translate(_BITS_TO_ASCII)[::-1], 2).to_bytes(len(flags) // 8, "little")
+            for i in range(0, len(bits), _BITMAP_BLOCK):
+                counts.append(count)
+                count += int.from_bytes(bits[i:i + _BITMAP_BLOCK], "little").bit_count()
+            f.write(bits)
+
+        f.seek(len(_BITMAP_MAGIC) + 8)
+        f.write(counts.tobytes())               # native byte order, the file is meant for the machine building it
+    os.replace(path + ".tmp", path)
+
+
+class PrimeBitmap:
+    """
+    Memory-mapped prime bitmap built by buildPrimeBitmap. Pages are loaded by the OS on first access,
+    so opening it is cheap. isPrime is a bit lookup, nextPrime and iteration scan the bitmap word by word,
+    and primeCount adds the count index to the popcount of at most one block
+    """
+    def __init__(self, path=PRIME_BITMAP_PATH):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(_BITMAP_MAGIC)] != _BITMAP_MAGIC:
+            raise ValueError("{} is not a prime bitmap".format(path))
+        header = len(_BITMAP_MAGIC)
+        self.limit = int.from_bytes(self.map[header:header + 8], "little")
+        nbytes = -(-(-(-self.limit // 2)) // 8)
+        nblocks = -(-nbytes // _BITMAP_BLOCK)
+        self.counts = memoryview(self.map)[header + 8:header + 8 + 4 * nblocks].cast("I")
+        self.offset = header + 8 + 4 * nblocks
+
+    def _bit(self, i):
+        return self.map[self.offset + (i >> 3)] >> (i & 7) & 1
+
+    def isPrime(self, n):
+        if n < 3 or n % 2 == 0:
+            return n == 2
+        if n >= self.limit:
+            raise ValueError("{} is beyond the prime bitmap".format(n))
+        return bool(self._bit(n >> 1))
+
+    def _setBits(self, lo, hi):
+        """ Yield the indices i in [lo, hi) of the set bits, scanning 64 bytes at a time """
+        pos = lo & ~7
+        while pos < hi:
+            chunk = self.map[self.offset + (pos >> 3):self.offset + (pos >> 3) + 64]
+            word = int.from_bytes(chunk, "little")
+            if pos < lo:
+                word &= ~((1 << (lo - pos)) - 1)
+            while word:
+                low = word & -word
+                i = pos + low.bit_length() - 1
+                if i >= hi:
+                    return
+                yield i
+                word ^= low
+            pos += 8 * len(chunk)
+
+    def primes(self, lo, hi):
+        """ Iterate over the primes p with lo <= p < hi """
+        hi = min(hi, self.limit)
+        if lo <= 2 < hi:
+            yield 2
+        for i in self._setBits(max(lo, 0) >> 1, hi >> 1):
+            if 2*i + 1 >= lo:
+                yield 2*i + 1
+
+    def nextPrime(self, n):
+        """ Return the smallest prime bigger than n, or None if it is beyond the bitmap """
+        return next(self.primes(n + 1, self.limit), None)
+
+    def primeCount(self, x):
+        """ Return the number of primes p <= x """
+        if x < 2:
+            return 0
+        if x >= self.limit:
+            raise ValueError("{} is beyond the prime bitmap".format(x))
+        bits = (x + 1) >> 1                     # odd numbers 1, 3, ..., <= x
+        block = (bits >> 3) // _BITMAP_BLOCK
+        if block == len(self.counts):
+            # x = limit - 1 and the bitmap ends on a block boundary: popcount the whole last block
+            block -= 1
+        start = self.offset + block * _BITMAP_BLOCK
+        end = self.offset + (bits >> 3)
+        word = int.from_bytes(self.map[start:end + 1], "little")
+        word &= (1 << (8 * (end - start) + (bits & 7))) - 1
+        return 1 + self.counts[block] + word.bit_count()
+
+
+_primeBitmap = None
+
+def primeBitmap():
+    """ Return the PrimeBitmap mapped from PRIME_BITMAP_PATH on first use, or None if the file was not built """
+    global _primeBitmap
+    if _primeBitmap is None:
+        _primeBitmap = PrimeBitmap(PRIME_BITMAP_PATH) if os.path.exists(PRIME_BITMAP_PATH) else False
+    return _primeBitmap or None
+
+def primeCount(x):
+    """ Return the number of primes p <= x """
+    bitmap = primeBitmap()
+    if bitmap is not None and x < bitmap.limit:
+        return bitmap.primeCount(x)
+    return sum(1 for _ in primeRange(2, x + 1))
+
+def primeRange(lo, hi):
+    """ Iterate over the primes p with lo <= p < hi """
+    bitmap = primeBitmap()
+    if bitmap is not None:
+        yield from bitmap.primes(lo, hi)
+        lo = max(lo, bitmap.limit)
+    p = nextPrime(lo - 1)
+    while p < hi:
+        yield p
+        p = nextPrime(p)
+
+
+def sieveSophieGermainWindow(start, length):
+    """
+    Sieve the odd candidates p = start + 2k, 0 <= k < length, removing every p such that p or 2p + 1 has a factor
+    in SMALL_PRIMES. start must be odd and at least SIEVE_BOUND. Return the surviving offsets k
+    """
+    flags = bytearray([1]) * length
+    for q in SMALL_PRIMES[1:]:
+        half = (q + 1) >> 1     # inverse of 2 mod q
+        # p = 0 mod q
+        k = (-start * half) % q
+        if k < length:
+            flags[k::q] = bytes(len(range(k, length, q)))
+        # 2p + 1 = 0 mod q, i.e., p = (q - 1) / 2 mod q
+        k = ((half - 1 - start) * half) % q
+        if k < length:
+            flags[k::q] = bytes(len(range(k, length, q)))
+    return [k for k in range(length) if flags[k]]
+
 
-    return nextPrime(n)
+_SG_WINDOW = 1 << 14
+_stopSearch = None
 
-def getShophieGermainPrime(b):
+
+def _initSearchWorker(event):
+    global _stopSearch
+    _stopSearch = event
+
+
+def _searchSophieGermain(b):
+    """
+    Worker of the Sophie Germain prime search: scan sieved windows from a random b-bit start until
+    a prime p with 2p + 1 prime is found, or until another worker has signalled success
+    """
+    start = randint(2**(b - 1), 2**b - 1) | 1
+    while True:
+        if start.bit_length() > b:
+            start = 2**(b - 1) + 1
+        for k in sieveSophieGermainWindow(start, _SG_WINDOW):
+            if _stopSearch is not None and _stopSearch.is_set():
+                return None
+            p = start + 2*k
+            sp = 2*p + 1
+            # Cheap base-2 Fermat tests on both numbers before the full primality tests
+            if pow(2, p - 1, p) != 1 or pow(2, sp - 1, sp) != 1:
+                continue
+            if p.bit_length() == b and isPrime(p, mrRounds(b)) and isPrime(sp, mrRounds(b + 1)):
+                return p
+        start += 2*_SG_WINDOW
+
+
+def _findSophieGermainPrime(b, workers):
+    """ Return a Sophie Germain prime p with b bits, using a pool of worker processes for large sizes """
+    if b < 2:
+        raise ValueError("There is no prime with less than 2 bits")
+
+    if b <= SIEVE_BOUND.bit_length():
+        # Small sizes: the sieve window would not fit above SIEVE_BOUND
+        p = getPrime(b)
+        while not isPrime(2*p + 1, mrRounds(b + 1)):
+            p = getPrime(b)
+        return p
+
+    if workers is None:
+        workers = (os.cpu_count() or 1) if b >= 512 else 1
+    if workers == 1:
+        return _searchSophieGermain(b)
+
+    event = multiprocessing.Event()
+    with ProcessPoolExecutor(workers, initializer=_initSearchWorker, initargs=(event,)) as pool:
+        futures = [pool.submit(_searchSophieGermain, b) for _ in range(workers)]
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        event.set()
+        return next(iter(done)).result()
+
+
+def getShophieGermainPrime(b, workers=None):
     """
     Find a Sophie Germain prime with b bits. p is Sophie Germain prime if:
     - p is prime
     - 2*p + 1 is prime
 
+    Candidates come from windows where every p such that p or 2p + 1 has a small factor has been sieved out.
+    For b >= 512 the search is spread over workers processes (default: one per CPU), stopped as soon as one succeeds
     """
-    p = getPrime(b - 1)
-    sp = 2*p + 1
-
-    while not isPrime(sp):
-        p = getPrime(b - 1)
-        sp = 2*p + 1
-    return p
+    return _findSophieGermainPrime(b - 1, workers)
 
-def genSafePrime(b):
+def genSafePrime(b, workers=None):
     """
     Find a safe prime with b bits. p is a safe prime if:
     - p is prime
     - p // 2 is prime
+
+    The search is the one of getShophieGermainPrime
     """
-    p = getPrime(b - 1)
-    sp = 2*p + 1
+    return 2*_findSophieGermainPrime(b - 1, workers) + 1
 
-    while not isPrime(sp):
-        p = getPrime(b - 1)
-        sp = 2*p + 1
-    return sp
+def _pollardBrent(n, limit=None):
+    """
+    Find a non-trivial factor of the odd composite n with Brent's variant of Pollard rho.
+    Products of |x - y| are accumulated in batches of m steps to pay one gcd per batch.
+    Return None if no factor is found within limit iterations (no limit if None)
+    """
+    m = 128
+    while True:
+        y, c = randint(1, n - 1), randint(1, n - 1)
+        g = r = q = 1
+        steps = 0
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(m, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += m
+            r <<= 1
+            steps += r
+            if limit is not None and g == 1 and steps > limit:
+                return None
+
+        if g == n:
+            # The batch overshot, go back step by step from the last saved y
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if g != n:
+            return g
+        if limit is not None:
+            return None
+        # the cycles mod every factor collided at once, retry with another polynomial
+
+
+def _xDbl(P, a24, n):
+    """ Double a point on a Montgomery curve By^2 = x^3 + Ax^2 + x in XZ coordinates, a24 = (A + 2)/4 """
+    x, z = P
+    s = (x + z) * (x + z) % n
+    d = (x - z) * (x - z) % n
+    t = s - d
+    return s * d % n, t * (d + a24 * t) % n
+
+def _xAdd(P, Q, D, n):
+    """ Add two points P and Q on a Montgomery curve in XZ coordinates knowing their difference D = P - Q """
+    u = (P[0] - P[1]) * (Q[0] + Q[1])
+    v = (P[0] + P[1]) * (Q[0] - Q[1])
+    return D[1] * (u + v) * (u + v) % n, D[0] * (u - v) * (u - v) % n
+
+def _xMul(k, P, a24, n):
+    """ Compute [k]P with the Montgomery ladder, k >= 1 """
+    R0, R1 = P, _xDbl(P, a24, n)
+    for bit in bin(k)[3:]:
+        if bit == '1':
+            R0, R1 = _xAdd(R1, R0, P, n), _xDbl(R1, a24, n)
+        else:
+            R0, R1 = _xDbl(R0, a24, n), _xAdd(R1, R0, P, n)
+    return R0
+
+
+# (B1, number of curves) per expected factor size, from the GMP-ECM recommendations for 15, 20 and 25 digits
+_ECM_SCHEDULE = ((2000, 25), (11000, 90), (50000, 300))
+_ECM_STAGE2_RATIO = 100
+_ECM_PRIMES = {}
+_ECM_MULTIPLIERS = {}
+
+
+def _ecmPrimes(bound):
+    if bound not in _ECM_PRIMES:
+        _ECM_PRIMES[bound] = _sieve(bound)
+    return _ECM_PRIMES[bound]
+
+def _ecmMultiplier(B1):
+    """ Product of the largest powers of every prime <= B1 that do not exceed B1 """
+    if B1 not in _ECM_MULTIPLIERS:
+        k = 1
+        for q in _ecmPrimes(B1 + 1):
+            qe = q
+            while qe * q <= B1:
+                qe *= q
+            k *= qe
+        _ECM_MULTIPLIERS[B1] = k
+    return _ECM_MULTIPLIERS[B1]
+
+def _ecmCurve(n, B1, B2):
+    """
+    Run one curve of Lenstra's elliptic curve method: a random Suyama curve, stage 1 up to B1 and
+    the standard continuation (Crandall and Pomerance, Alg. 7.4.4) up to B2. Return a factor of n or None
+    """
+    sigma = randint(6, n - 1)
+    u = (sigma * sigma - 5) % n
+    v = 4 * sigma % n
+    den = 16 * pow(u, 3, n) * v % n
+    g = gcd(den, n)
+    if g != 1:
+        return g if g != n else None
+    a24 = pow(v - u, 3, n) * (3 * u + v) * pow(den, -1, n) % n
+    Q = (pow(u, 3, n), pow(v, 3, n))
+
+    # Stage 1
+    Q = _xMul(_ecmMultiplier(B1), Q, a24, n)
+    g = gcd(Q[1], n)
+    if g != 1:
+        return g if g != n else None
+
+    # Stage 2: S[d] = [2d]Q, catches a single prime q in (B1, B2] in the order of the group
+    D = 100
+    S = [None] * (D + 1)
+    S[1] = _xDbl(Q, a24, n)
+    S[2] = _xDbl(S[1], a24, n)
+    for d in range(3, D + 1):
+        S[d] = _xAdd(S[d - 1], S[1], S[d - 2], n)
+    beta = [None] + [x * z % n for x, z in S[1:]]
+
+    B = B1 - 1 if B1 % 2 == 0 else B1 - 2
+    R = _xMul(B, Q, a24, n)
+    T = _xMul(B - 2*D, Q, a24, n)
+    primes = _ecmPrimes(B2 + 2*D)
+    idx = bisect_right(primes, B)
+    acc = 1
+    for r in range(B, B2, 2*D):
+        alpha = R[0] * R[1] % n
+        while idx < len(primes) and primes[idx] <= r + 2*D:
+            d = (primes[idx] - r) >> 1
+            acc = acc * ((R[0] - S[d][0]) * (R[1] + S[d][1]) - alpha + beta[d]) % n
+            idx += 1
+        R, T = _xAdd(R, S[D], T, n), R
+    g = gcd(acc, n)
+    return g if g not in (1, n) else None
+
+def _ecm(n):
+    """ Find a non-trivial factor of the composite n with ECM, raising B1 along _ECM_SCHEDULE """
+    while True:
+        for B1, curves in _ECM_SCHEDULE:
+            for _ in range(curves):
+                g = _ecmCurve(n, B1, _ECM_STAGE2_RATIO * B1)
+                if g is not None:
+                    return g
+
+# Pollard rho iterations before switching to ECM, enough for factors up to about 35 bits
+_RHO_LIMIT = 1 << 18
+
+def _findFactor(n, ecm):
+    """ Return a non-trivial factor of the odd composite n without small factors """
+    r = isqrt(n)
+    if r * r == n:
+        return r
+    if not ecm:
+        return _pollardBrent(n)
+    g = _pollardBrent(n, _RHO_LIMIT)
+    return g if g is not None else _ecm(n)
+
+def factor(n, ecm=True):
+    """
+    Factorize an integer n > 0. Return the sorted list of its prime factors, repeated according to their multiplicities.
+    - trial division by SMALL_PRIMES
+    - Brent's Pollard rho on the remaining composite cofactors, followed by ECM if ecm is True
+    - each cofactor is checked with isPrime before trying to split it
+    """
+    if n < 1:
+        raise ValueError("Only positive integers can be factorized")
 
-def factor(n):
-    """  Factorize an integer n  """
-    p = 2
     factors = []
-    while n != 1:
+    for p in SMALL_PRIMES:
+        if p * p > n:
+            break
         while n % p == 0:
             factors.append(p)
-            n /= p
-        p = nextPrime(p)
-    return factors
+            n //= p
+    if n == 1:
+        return factors
+
+    stack = [n]
+    while stack:
+        m = stack.pop()
+        if m < SIEVE_BOUND * SIEVE_BOUND or isPrime(m):
+            # m has no factor below SIEVE_BOUND, so it is prime if it is below SIEVE_BOUND^2
+            factors.append(m)
+            continue
+        d = _findFactor(m, ecm)
+        stack += [d, m // d]
+    return sorted(factors)
 
 
 def tests():
@@ -166,6 +895,9 @@ def tests():
     else:
         print("{} is not a prime".format(n))
 
+    # A strong pseudoprime to the bases 2 to 23 does not pass the strong Lucas test
+    assert _millerRabin(3825123056546413051, _DETERMINISTIC_BASES[:9]) and not _strongLucas(3825123056546413051)
+
     p = nextPrime(n)
     assert isPrime(p), "p is not a prime"
     print("The next prime after {} is {}".format(n, p))
@@ -182,6 +914,54 @@ def tests():
     assert isPrime(p), "p is not a safe prime"
     print("{} is a safe prime with {} bits".format(p, b))
 
+    # Prime counts from the index against a scan of the bitmap, up to limit - 1
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        for limit in (1 << 17, 100003):
+            path = os.path.join(tmp, "primes.bitmap")
+            buildPrimeBitmap(path, limit)
+            bitmap = PrimeBitmap(path)
+            for x in (0, 2, 3, 16 * _BITMAP_BLOCK - 1, 16 * _BITMAP_BLOCK, limit - 2, limit - 1):
+                assert bitmap.primeCount(x) == sum(1 for _ in bitmap.primes(2, x + 1)), x
+    print("Prime bitmap counts: OK")
+
+
+
+def benchmarks(bits=2048, count=20):
+    """ Compare powmod, the built-in pow and FixedBasePow for count exponentiations with the same base """
+    mod = getPrime(bits)
+    g = randint(2, mod - 1)
+    exps = [randint(1, mod - 1) for _ in range(count)]
+
+    start = perf_counter()
+    table = FixedBasePow(g, mod)
+    print("FixedBasePow table: {:.1f} ms, {} KiB".format((perf_counter() - start) * 1000, table.nbytes() >> 10))
+
+    for name, f in (("powmod", lambda e: powmod(g, e, mod)), ("pow", lambda e: pow(g, e, mod)), ("FixedBasePow", table.pow)):
+        start = perf_counter()
+        for e in exps:
+            f(e)
+        print("{:>12}: {:.2f} ms per {}-bit exponentiation".format(name, (perf_counter() - start) * 1000 / count, bits))
+
+    for terms in (4, 64, 1000):
+        bases = [randint(2, mod - 1) for _ in range(terms)]
+        exps = [randint(1, mod - 1) for _ in range(terms)]
+
+        start = perf_counter()
+        r = 1
+        for b, e in zip(bases, exps):
+            r = r * pow(b, e, mod) % mod
+        separate = perf_counter() - start
+
+        start = perf_counter()
+        assert multiPowmod(bases, exps, mod) == r
+        multi = perf_counter() - start
+        print("{:>5} terms: {:.1f} ms with pow, {:.1f} ms with multiPowmod".format(terms, separate * 1000, multi * 1000))
+
 
 if __name__ == '__main__':
     tests()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmarks()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bitmap':
+        buildPrimeBitmap()